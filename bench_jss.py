@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Manfred Roiger <manfred.roiger@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''bench_jss.py
+
+Throughput benchmark of c2sg_bulk.py and mvc2c.py against mock_jss.py.
+A synthetic JSS is started in this process, a csv file with random
+[computer,id] rows and a mapping file with random [source,destination]
+pairs are generated. Every script runs as a child process with its own
+settings file and an empty cache.
+
+For every run we report total runtime, requests/sec, p50/p99 latency of
+the requests seen by the mock JSS, peak RSS of the script and its exit code.
+With --baseline the runtimes are compared to a previous --json result and
+the benchmark fails if a run is slower than the tolerance allows.
+
+    usage: bench_jss.py [-h] [--rows ROWS] [--mappings MAPPINGS]
+                        [--invalid-rate INVALID_RATE] [--python PYTHON]
+                        [--bulk-args BULK_ARGS] [--mvc2c-args MVC2C_ARGS]
+                        [--json JSON] [--baseline BASELINE]
+                        [--tolerance TOLERANCE] [mock options]
+'''
+
+import argparse
+import csv
+import json
+import os
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import mock_jss
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def write_rows(filename, jss, rows, invalid_rate, rnd):
+    '''Write a csv file with random [computer,id] rows, some of them invalid.'''
+    computers = sorted(jss.computers.values())
+    static_ids = sorted(gid for gid, group in jss.groups.items() if not group['is_smart'])
+    with open(filename, 'w') as csv_file:
+        writer = csv.writer(csv_file)
+        for i in range(rows):
+            computer = rnd.choice(computers)
+            gid = rnd.choice(static_ids)
+            if rnd.random() < invalid_rate:
+                computer = 'unknown%05d' % i
+            writer.writerow([computer, gid])
+
+
+def write_mappings(filename, jss, mappings, rnd):
+    '''Write a mapping file with random [source,destination] pairs.'''
+    computers = sorted(jss.computers.values())
+    with open(filename, 'w') as csv_file:
+        writer = csv.writer(csv_file)
+        for i in range(mappings):
+            writer.writerow([rnd.choice(computers), rnd.choice(computers)])
+
+
+def peak_rss(rusage):
+    '''Peak resident set size in MB, ru_maxrss is KB on Linux and bytes on macOS.'''
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss / 1024.0 / 1024.0
+    return rusage.ru_maxrss / 1024.0
+
+
+def run(name, argv, env, jss):
+    '''Run one script as child process and collect the measurements.'''
+    jss.reset_stats()
+    started = time.time()
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(argv, env=env, stdout=devnull)
+        # wait4 gives us the resource usage of exactly this child
+        pid, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.WEXITSTATUS(status)
+    runtime = time.time() - started
+    stats = jss.stats()
+    return {'name': name,
+            'exit_code': process.returncode,
+            'runtime': runtime,
+            'requests': stats['requests'],
+            'requests_per_second': stats['requests'] / runtime if runtime > 0 else 0,
+            'p50': stats['p50'],
+            'p99': stats['p99'],
+            'peak_rss_mb': peak_rss(rusage),
+            'endpoints': stats['endpoints']}
+
+
+def print_results(results):
+    print('%-12s %4s %10s %9s %9s %9s %9s %12s' %
+          ('script', 'rc', 'runtime s', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'peak RSS MB'))
+    for result in results:
+        print('%-12s %4d %10.2f %9d %9.1f %9.1f %9.1f %12.1f' %
+              (result['name'], result['exit_code'], result['runtime'], result['requests'],
+               result['requests_per_second'], result['p50'] * 1000, result['p99'] * 1000,
+               result['peak_rss_mb']))
+
+
+def regressions(results, baseline, tolerance):
+    '''Return the names of all runs that are slower than baseline * (1 + tolerance).'''
+    previous = dict((result['name'], result) for result in baseline)
+    slower = []
+    for result in results:
+        if result['name'] in previous and \
+                result['runtime'] > previous[result['name']]['runtime'] * (1 + tolerance):
+            slower.append(result['name'])
+    return slower
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--rows', type=int, default=100000,
+                    help="Optional: Rows of the csv file for c2sg_bulk.py (default 100000).")
+parser.add_argument('--mappings', type=int, default=500,
+                    help="Optional: Pairs of the mapping file for mvc2c.py (default 500).")
+parser.add_argument('--invalid-rate', type=float, default=0.01,
+                    help="Optional: Fraction of csv rows with an unknown computer (default 0.01).")
+parser.add_argument('--python', type=str, default=sys.executable,
+                    help="Optional: Python interpreter for the scripts (default this one).")
+parser.add_argument('--bulk-args', type=str, default='',
+                    help="Optional: Extra options for c2sg_bulk.py, i.e. '--workers 8'.")
+parser.add_argument('--mvc2c-args', type=str, default='',
+                    help="Optional: Extra options for mvc2c.py, i.e. '--idempotent'.")
+parser.add_argument('--json', type=str,
+                    help="Optional: Write the results as JSON to this file.")
+parser.add_argument('--baseline', type=str,
+                    help="Optional: JSON results of a previous run to compare the runtimes with.")
+parser.add_argument('--tolerance', type=float, default=0.2,
+                    help="Optional: Allowed slowdown against the baseline (default 0.2).")
+mock_jss.add_arguments(parser)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    rnd = random.Random(1)
+    workdir = tempfile.mkdtemp(prefix='bench_jss')
+    try:
+        jss = mock_jss.from_arguments(args)
+        server = mock_jss.MockJSSServer(jss)
+        server.start()
+
+        settings = os.path.join(workdir, 'settings.json')
+        with open(settings, 'w') as settings_file:
+            json.dump({'jss_url': server.url, 'jss_user': 'bench', 'jss_pass': 'bench',
+                       'jss_verify': 0, 'jss_warn': 1}, settings_file)
+        rows = os.path.join(workdir, 'rows.csv')
+        write_rows(rows, jss, args.rows, args.invalid_rate, rnd)
+        mappings = os.path.join(workdir, 'mappings.csv')
+        write_mappings(mappings, jss, args.mappings, rnd)
+
+        # HOME points to the work directory so every run starts with an empty cache
+        env = dict(os.environ, MVC2C_SETTINGS=settings, HOME=workdir)
+        results = []
+        results.append(run('c2sg_bulk.py', [args.python, os.path.join(HERE, 'c2sg_bulk.py'), rows] +
+                           shlex.split(args.bulk_args), env, jss))
+        shutil.rmtree(os.path.join(workdir, 'Library'), ignore_errors=True)
+        results.append(run('mvc2c.py', [args.python, os.path.join(HERE, 'mvc2c.py'), '-m', mappings] +
+                           shlex.split(args.mvc2c_args), env, jss))
+        server.shutdown()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            slower = regressions(results, json.load(baseline_file), args.tolerance)
+        if slower:
+            print('Slower than baseline: ' + ', '.join(slower))
+            sys.exit(1)
@@ -22,11 +22,12 @@ we only use assignments to static computergroups.
 '''
 
 import requests
-from requests.packages import urllib3
-import json
 import sys
 import argparse
-import getpass
+import jss_cache
+import jss_client
+import jss_index
+import jss_profile
 from string import lower
 
 # Set this flag to True to enable print output of various intermediate results
@@ -35,56 +36,23 @@ from string import lower
 # url for the put.
 _debug = False
 
-# The connection settings must be provided in a JSON file:
+# The connection settings are read from a JSON file:
 #   filename: ~//Library/Preferences/com.github.mvc2c.plist
-#   dict with connection settings:
-#       {
-#           'jss_pass':'yourPassword',
-#           'jss_user':'yourUser',
-#           'jss_url':'https://yourJSSUrl:8443',
-#           'jss_verify':0,
-#           'jss_warn':1
-#       }
-#       if your JSS has a self signed certificate set jsss_verify to 0 and jss_warn to 1
-#       jss_url must be the full url including https:// and port i.e. :8443
-logged_in_user = getpass.getuser()
-with open('/Users/' + logged_in_user + '/Library/Preferences/com.github.mvc2c.plist', 'r') as jss_settings:
-    pl = json.load(jss_settings)
+#   see jss_client.py for the dict with connection settings
+pl = jss_client.load_settings()
 
 # Full url i.e. https://jssserver.domain.com:8443
 jss_url = pl['jss_url']
-# The user needs read access to computers and computergroups and update access to computergroups
-jss_user = pl['jss_user']
-jss_pass = pl['jss_pass']
-# If set to True (1) we disable warnigs for self signed certificates
-jss_warn = pl['jss_warn']
-# If set to False (0) we disable ssl verify for self signed certificates
-jss_verify = pl['jss_verify']
-
-# Disable urrlib3 warnigs for JSS with self signed certificate
-if jss_warn:
-    urllib3.disable_warnings()
-
-s = requests.Session()
-s.auth = (jss_user, jss_pass)
-s.headers.update({'Accept': 'application/json'})
-s.verify = jss_verify
-
-def get_computer(computer):
-    '''Get full set of computer information that can be retrieved by computer name!'''
-    try:
-        response = s.get(jss_url + '/JSSResource/computers/name/' + computer)
-    except requests.exceptions.ProxyError:
-        print('Cannot connect to ' + jss_url + ' ProxyError .. exiting')
-        sys.exit(1)
-    if response.status_code != requests.codes.ok:
-        print("Request " + computer + " by name failed with return code: " + str(response.status_code))
-        sys.exit(response.status_code)
-    else:
-        content = json.loads(response.content)
-        if _debug:
-            print(content['computer']['general']['id'])
-        return content
+# Optional: Seconds the local computergroups cache is valid
+jss_cache_ttl = pl.get('jss_cache_ttl', jss_cache.DEFAULT_TTL)
+
+# Session with pooled keep-alive connections, transient errors are retried
+s = jss_client.JSSSession(pl)
+
+def is_member(computer, group):
+    '''Check if a computer is already a member of a static group, asks JSS for the current members.'''
+    group_members = jss_cache.get_members(s, jss_url, group)
+    return group_members != None and jss_client.normalize(computer) in group_members[1]
 
 '''
     Script can be started with three optional parameters:
@@ -99,8 +67,18 @@ parser.add_argument("-s", "--software", type=str,
                     help="Optional: Name of a software a computer will be assigned to.")
 parser.add_argument("-i", "--id", type=str,
                     help="Optional: Group ID of a software a computer will be assigned to. Ignored if -s is present.")
+parser.add_argument("--refresh", action="store_true",
+                    help="Optional: Ignore the local computergroups cache and reload it from JSS.")
+parser.add_argument("--idempotent", action="store_true",
+                    help="Optional: Only add the computer to groups it is not yet a member of.")
+parser.add_argument("--profile", type=str,
+                    help="Optional: Write a JSON trace with phase durations and request statistics to this file.")
 args = parser.parse_args()
 
+# With --profile every request and the main phases are timed
+if args.profile != None:
+    jss_profile.enable(args.profile)
+
 # Computer name is fetched from args (-c) or read from input
 if args.computer != None:
     computer = args.computer
@@ -108,41 +86,35 @@ else:
     computer = raw_input('Enter a computer name: ')
 
 # Check if the computer exists in JSS. The function exits if the computer does not exist
-# We don't need the content in this script
-get_computer(computer)
-
-# Get all computergroups from jss
-try:
-    response = s.get(jss_url + '/JSSResource/computergroups')
-except requests.exceptions.ProxyError:
-    print('Cannot connect to ' + jss_url + ' ProxyError .. exiting')
-    sys.exit(1)
-if response.status_code != requests.codes.ok:
-    print('Could not load computergroups, return code was: ' + str(response.status_code))
-
-computergroups = json.loads(response.content)
-
-# In static_groups we select all static groups from computegroups
-static_groups = []
+# We don't need the content in this script, so we only load the General subset
+jss_profile.start('lookup computer')
+jss_client.get_computer(s, computer, debug=_debug)
+jss_profile.stop('lookup computer')
+
+# Get all computergroups from the local cache or from jss
+jss_profile.start('load computergroups')
+computergroups = jss_cache.get_computergroups(s, jss_url, jss_cache_ttl, args.refresh)
+jss_profile.stop('load computergroups')
+
+# In static_groups we index all static groups from computegroups by id and name
+# we only assign to static groups
+jss_profile.start('group extraction')
+static_groups = jss_index.StaticGroupIndex(computergroups)
+jss_profile.stop('group extraction')
 # gid will be the list with static group ids the computer will be assigned to
 # we append only strings to gid because we need strings for our put url
 gid = []
 
-# Extract all static groups from computer groups, we only assign to static groups
-for value in computergroups['computer_groups']:
-    if value['is_smart'] == False:
-        static_groups.append([value['id'], value['name']])
-
 # We allow to further narrow the computergroups by matching a software name
 group_selection = []
 
 # Check which software should be assigend either from args (-s) or read from input
 if args.software != None:
     software = lower(args.software)
-    for value in static_groups:
-        if software in lower(value[1]):
-            print('ID: %3d : %s' % (value[0], value[1]))
-            group_selection.append(value)
+    with jss_profile.phase('group search'):
+        group_selection = static_groups.search(software)
+    for value in group_selection:
+        print('ID: %3d : %s' % (value[0], value[1]))
     if len(group_selection) == 0:
         print('No software found that matches: ' + software)
         sys.exit(1)
@@ -150,24 +122,18 @@ if args.software != None:
 # If no -s option was in args, there might be a -i option
 # If an -s option is in args, we ignore the -i option
 elif args.id != None:
-    for value in static_groups:
-        if args.id in str(value[0]):
-            gid.append(args.id)
-            break
+    if static_groups.get(args.id) != None:
+        gid.append(args.id.strip())
     if len(gid) == 0:
         print('No software with ID: ' + str(args.id) + ' found .. exiting!')
         sys.exit(1)
 else:
+    # An empty input matches all static groups
     software = raw_input('Please enter a software name or hit <Enter> for a complete list: ')
-    if software != None:
-        for value in static_groups:
-            if lower(software) in lower(value[1]):
-                print('ID: %3d : %s' % (value[0], value[1]))
-                group_selection.append(value)
-    else:
-        for value in static_groups:
-            print('ID: %3d : %s' % (value[0], value[1]))
-            group_selection.append(value)
+    with jss_profile.phase('group search'):
+        group_selection = static_groups.search(software)
+    for value in group_selection:
+        print('ID: %3d : %s' % (value[0], value[1]))
 
     if len(group_selection) == 0:
         print('Nothing selected .. exiting!')
@@ -184,11 +150,10 @@ if len(gid) == 0:
             spelling_wrong = False
         group_to_update = raw_input('Please enter the ID of a software you want to assign, hit <Enter> when finished: ')
         if group_to_update != '':
-            for value in group_selection:
-                if group_to_update in  str(value[0]):
-                    spelling_wrong = False
-                    gid.append(str(group_to_update))
-                    break
+            # Only ids of the displayed selection are accepted
+            if static_groups.get(group_to_update) in group_selection:
+                spelling_wrong = False
+                gid.append(group_to_update.strip())
             else:
                 spelling_wrong = True
         else:
@@ -204,18 +169,26 @@ if len(gid) == 0:
 s.headers.update({'content-type': 'application/xml'})
 data = '<computer_group><computer_additions><computer><name>' + computer + '</name></computer></computer_additions></computer_group>'
 
+jss_profile.start('put loop')
 for group in gid:
+    # Skip groups the computer is already a member of
+    if args.idempotent and is_member(computer, group):
+        print(computer + ' is already a member of group with id: ' + str(group))
+        continue
     group_url = jss_url + '/JSSResource/computergroups/id/' + group
     if _debug:
         print (group_url)
     else:
         try:
             response = s.put(url=group_url, data=data)
-        except requests.exceptions.ProxyError:
-            print('Cannot connect to ' + jss_url + ' ProxyError .. exiting')
+        except requests.exceptions.ConnectionError:
+            print('Cannot connect to ' + jss_url + ' .. exiting')
             sys.exit(1)
+        # Membership of the group changed, the snapshot entry must be reloaded
+        jss_cache.invalidate_groups(jss_url, [group])
         if response.status_code == 201:
             print('Added ' + computer + ' to group with id: ' + str(group))
         else:
             print('Update for group ' + str(group) + ' failed with return code: ' + str(response.status_code))
-            sys.exit(response.status_code)
\ No newline at end of file
+            sys.exit(response.status_code)
+jss_profile.stop('put loop')
@@ -32,14 +32,32 @@ For example export a JSS advanced computer search, delete everything except
 the computer names and add a column with static group id(s).
 To prevent weird results or corruption of the JSS database.
 we only use assignments to static computergroups.
+
+With --sync the file is the desired state of the groups it contains: missing
+computers are added and all other members are removed, with one PUT per group.
+
+With --key the first column has serial numbers, MAC addresses or UDIDs
+instead of computer names, i.e. an export of an asset system.
+
+With --verify the members of every updated group are loaded once after the
+PUTs and all computers that were reported as added are checked.
 '''
 
 import requests
-from requests.packages import urllib3
 import json
 import sys
 import argparse
-import getpass
+import os
+import jss_cache
+import jss_client
+import jss_index
+import jss_profile
+import jss_verify
+import csv
+import threading
+import time
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
 
 # Set this flag to True to enable print output of various intermediate results
 # If you run this script for the first time in your environment i recommend
@@ -47,127 +65,625 @@ import getpass
 # url for the put.
 _debug = False
 
-# The connection settings must be provided in a JSON file:
+# The connection settings are read from a JSON file:
 #   filename: ~//Library/Preferences/com.github.mvc2c.plist
-#   dict with connection settings:
-#       {
-#           'jss_pass':'yourPassword',
-#           'jss_user':'yourUser',
-#           'jss_url':'https://yourJSSUrl:8443',
-#           'jss_verify':0,
-#           'jss_warn':1
-#       }
-#       if your JSS has a self signed certificate set jsss_verify to 0 and jss_warn to 1
-#       jss_url must be the full url including https:// and port i.e. :8443
-logged_in_user = getpass.getuser()
-with open('/Users/' + logged_in_user + '/Library/Preferences/com.github.mvc2c.plist', 'r') as jss_settings:
-    pl = json.load(jss_settings)
+#   see jss_client.py for the dict with connection settings
+pl = jss_client.load_settings()
 
 # Full url i.e. https://jssserver.domain.com:8443
 jss_url = pl['jss_url']
-# The user needs read access to computers and computergroups and update access to computergroups
-jss_user = pl['jss_user']
-jss_pass = pl['jss_pass']
-# If set to True (1) we disable warnigs for self signed certificates
-jss_warn = pl['jss_warn']
-# If set to False (0) we disable ssl verify for self signed certificates
-jss_verify = pl['jss_verify']
-
-# Disable urrlib3 warnigs for JSS with self signed certificate
-if jss_warn:
-    urllib3.disable_warnings()
-
-s = requests.Session()
-s.auth = (jss_user, jss_pass)
-s.headers.update({'Accept': 'application/json'})
-s.verify = jss_verify
+# Optional: Seconds the local computergroups cache is valid
+jss_cache_ttl = pl.get('jss_cache_ttl', jss_cache.DEFAULT_TTL)
 
 def get_computer(computer):
-    '''Get full set of computer information that can be retrieved by computer name.'''
-    s.headers.update({'Accept': 'application/json'})
-    try:
-        response = s.get(jss_url + '/JSSResource/computers/name/' + computer)
-    except requests.exceptions.ProxyError:
-        print('Cannot connect to ' + jss_url + ' ProxyError .. exiting')
-        sys.exit(1)
-    if response.status_code != requests.codes.ok:
-        print("Search for " + computer + " failed with return code: " + str(response.status_code))
-        return False
-    else:
-        return True
+    '''Look up the id of a computer by its --key in the computer index.'''
+    return jss_client.find_computer(computer_index, args.key, computer)
 
 def get_software(gid, static_groups):
-    '''Search for software in list of static computergrups.'''
-    for value in static_groups:
-        if gid in str(value):
-            # ID matches one group return True
-            return True
-    # If nothing matches return False
+    '''Look up the exact group id in the index of static computergrups.'''
+    if static_groups.get(gid) != None:
+        return True
     print('No such static group: ' + gid)
     return False
 
+def put_members(group, additions, deletions):
+    '''Add and remove computers of a static group with a single PUT.
+
+    additions and deletions are lists of (computer id, computer name) tuples.
+    Returns the status code of the PUT.
+    '''
+    data = '<computer_group>'
+    for tag, computers in (('computer_additions', additions), ('computer_deletions', deletions)):
+        if len(computers) > 0:
+            data += '<' + tag + '>'
+            for computer_id, computer in computers:
+                data += '<computer><id>' + str(computer_id) + '</id></computer>'
+            data += '</' + tag + '>'
+    data += '</computer_group>'
+    group_url = jss_url + '/JSSResource/computergroups/id/' + group
+    if _debug:
+        print (group_url)
+        print (data)
+        return 201
+    response = s.put(url=group_url, data=data, headers={'content-type': 'application/xml'})
+    return response.status_code
+
+def put_computers(group, computers):
+    '''Add a chunk of computers to a static group with a single PUT.
+
+    computers is a list of (computer id, computer name) tuples.
+    Returns a list of (computer, group, status_code) tuples, one for every
+    computer in the chunk, so the caller can report each row on its own.
+    '''
+    status_code = put_members(group, computers, [])
+    return [(computer, group, status_code) for computer_id, computer in computers]
+
+def put_chunk(group, chunk):
+    '''Send one chunk of a static group, called by drain_group().
+
+    Connection problems are reported as results with status_code None.
+    With --idempotent the members of the group are loaded once from JSS (not
+    from the snapshot, it may miss changes made since) and only missing
+    computers are sent, members are reported with status_code 304.
+    '''
+    results = []
+    try:
+        if args.idempotent:
+            if group not in members:
+                members[group] = jss_cache.load_members(s, jss_url, group)
+            if members[group] != None:
+                member_ids = members[group][0]
+                results = [(computer, group, 304) for computer_id, computer in chunk
+                           if computer_id in member_ids]
+                chunk = [(computer_id, computer) for computer_id, computer in chunk
+                         if computer_id not in member_ids]
+        if len(chunk) > 0:
+            put_results = put_computers(group, chunk)
+            if args.idempotent and members[group] != None and put_results[0][2] == 201:
+                members[group][0].update(computer_id for computer_id, computer in chunk)
+            results.extend(put_results)
+        return results
+    except requests.exceptions.RequestException:
+        connection_lost.set()
+        return results + [(computer, group, None) for computer_id, computer in chunk]
+
+def queue_chunk(group, chunk):
+    '''Queue a chunk of a static group, start a drain_group() task if the group has none.'''
+    with queue_lock:
+        group_queues.setdefault(group, deque()).append(chunk)
+        if group in draining:
+            return
+        draining.add(group)
+    pool.apply_async(drain_group, (group,))
+
+def drain_group(group):
+    '''Send the queued chunks of a static group one after the other in a worker thread.
+
+    Only one task per group runs at a time, so updates of the same group
+    never race and the pool threads stay free for the other groups.
+    '''
+    while True:
+        with queue_lock:
+            if len(group_queues[group]) == 0:
+                draining.discard(group)
+                return
+            chunk = group_queues[group].popleft()
+        try:
+            try:
+                results = put_chunk(group, chunk)
+            except Exception as error:
+                # apply_async reports nothing, the queued chunks of the group would never be sent
+                fail_group(group, chunk, error.__class__.__name__ + ': ' + str(error))
+                return
+            with report_lock:
+                report(results)
+        finally:
+            slots.release()
+
+def fail_group(group, chunk, error):
+    '''Report the chunk and all queued chunks of a group as failed after an unexpected error.
+
+    The group is no longer draining, chunks queued later start a new task.
+    '''
+    with queue_lock:
+        chunks = [chunk] + list(group_queues[group])
+        group_queues[group].clear()
+        draining.discard(group)
+    with report_lock:
+        for failed_chunk in chunks:
+            report([(computer, group, None) for computer_id, computer in failed_chunk], error)
+    # The current chunk is released by drain_group(), every queued one holds a slot too
+    for queued in chunks[1:]:
+        slots.release()
+
+def sync_group(group, desired):
+    '''--sync: make the members of a static group exactly the desired computers.
+
+    The current members are always loaded from JSS (not from the snapshot),
+    additions and deletions are sent with one PUT. Runs in a worker thread
+    (one task per group, so it never races with itself) and returns (group, desired, additions, deletions, status_code),
+    status_code is 304 if nothing had to change and None if the connection
+    was lost.
+    '''
+    try:
+        gid, status_code, current = jss_cache.fetch_members(s, jss_url, group)
+        if status_code != requests.codes.ok:
+            return group, desired, [], [], status_code
+        current = OrderedDict(current)
+        additions = [(computer_id, computer) for computer_id, computer in desired.items()
+                     if computer_id not in current]
+        deletions = [(computer_id, computer) for computer_id, computer in current.items()
+                     if computer_id not in desired]
+        if len(additions) == 0 and len(deletions) == 0:
+            return group, desired, [], [], 304
+        return group, desired, additions, deletions, put_members(group, additions, deletions)
+    except requests.exceptions.RequestException:
+        connection_lost.set()
+        return group, desired, [], [], None
+    finally:
+        slots.release()
+
+def read_journal(filename):
+    '''Return the set of (computer, group) that were added in a previous run.'''
+    done = set()
+    try:
+        with open(filename, 'r') as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may be incomplete if a run was killed
+                    continue
+                if entry['status'] == 'added':
+                    done.add((jss_client.normalize_key(args.key, entry['computer']), entry['group']))
+    except IOError:
+        pass
+    return done
+
+def log_row(status, computer, group, status_code=None):
+    '''Append the outcome of one row to the journal.'''
+    if journal is None:
+        return
+    entry = {'status': status, 'computer': computer, 'group': group}
+    if status_code is not None:
+        entry['code'] = status_code
+    with journal_lock:
+        journal.write(json.dumps(entry) + '\n')
+
+def report(results, error=None):
+    '''Print the result of every computer of a chunk, drain_group() calls it with report_lock held.
+
+    Every computer is logged in the journal, failed ones also go to the
+    dead letter file that can be used as csv file for a retry. status_code
+    None is a lost connection or the given error.
+    '''
+    global failed, progress
+    progress += len(results)
+    for computer, group_id, status_code in results:
+        if args.verify and status_code in (201, 304):
+            # --verify checks that the computer really is a member
+            computer_id = computer_index[jss_client.normalize_key(args.key, computer)]
+            expected.setdefault(group_id, OrderedDict())[computer_id] = computer
+        if status_code == 201:
+            print('Added ' + computer + ' to group with id: ' + str(group_id))
+            log_row('added', computer, group_id, status_code)
+            continue
+        if status_code == 304:
+            print(computer + ' is already a member of group with id: ' + str(group_id))
+            log_row('added', computer, group_id, status_code)
+            continue
+        if status_code is None:
+            print('Adding ' + computer + ' to group ' + str(group_id) + ' failed: ' +
+                  (error or 'Cannot connect to ' + jss_url))
+        else:
+            print('Adding ' + computer + ' to group ' + str(group_id) + ' failed with return code: ' + str(status_code))
+        log_row('failed', computer, group_id, status_code)
+        dead_letter.writerow([computer, group_id])
+        failed += 1
+    if journal is not None:
+        with journal_lock:
+            journal.flush()
+    dead_letter_file.flush()
+
+def report_sync(result):
+    '''Print the outcome of the sync of one group, runs in the pool result thread.
+
+    All rows of a failed group go to the dead letter file, so it can be
+    synced again on its own.
+    '''
+    global failed, progress
+    group, desired, additions, deletions, status_code = result
+    progress += len(desired)
+    if args.verify and status_code in (201, 304):
+        # --verify checks that the group has exactly the desired members
+        expected[group] = desired
+    if status_code == 304:
+        print('Group with id: ' + group + ' is already in sync')
+    elif status_code == 201:
+        for computer_id, computer in additions:
+            print('Added ' + computer + ' to group with id: ' + group)
+            log_row('added', computer, group, status_code)
+        for computer_id, computer in deletions:
+            print('Removed ' + computer + ' from group with id: ' + group)
+            log_row('removed', computer, group, status_code)
+    else:
+        if status_code is None:
+            print('Sync of group ' + group + ' failed: Cannot connect to ' + jss_url)
+        else:
+            print('Sync of group ' + group + ' failed with return code: ' + str(status_code))
+        for computer in desired.values():
+            log_row('failed', computer, group, status_code)
+            dead_letter.writerow([computer, group])
+        failed += 1
+    if journal is not None:
+        with journal_lock:
+            journal.flush()
+    dead_letter_file.flush()
+
+def show_status(limiter, finished):
+    '''--adaptive: rewrite a status line on stderr every second until finished is set.'''
+    last_completed = 0
+    last_time = time.time()
+    while not finished.wait(1):
+        now = time.time()
+        completed = limiter.completed
+        sys.stderr.write('\rConcurrency %d/%d, %.1f requests/s, %d computer(s) done, latency %d ms, %d error(s) ' %
+                         (int(limiter.limit), limiter.ceiling, (completed - last_completed) / (now - last_time),
+                          progress, (limiter.latency or 0) * 1000, limiter.errors))
+        sys.stderr.flush()
+        last_completed = completed
+        last_time = now
+    sys.stderr.write('\n')
+
+def check_row(computer, group):
+    '''Validate computer name and group id of one csv row.
+
+    Returns the computer id or None if the row is invalid.
+    '''
+    # Evaluate both checks so every problem of a row is printed
+    computer_id = get_computer(computer)
+    group_ok = get_software(group, static_groups)
+    if group_ok:
+        return computer_id
+    return None
+
+def read_rows(filename):
+    '''Read the csv file one row at a time, see jss_client.read_csv() for the separator.
+
+    Yields (row, computer, group) for every row that is not empty.
+    '''
+    with open(filename, 'r') as csv_file:
+        for row in jss_client.read_csv(csv_file):
+            if len(row) == 0:
+                continue
+            computer = row[0].strip()
+            group = row[1].strip() if len(row) > 1 else ''
+            yield row, computer, group
+
+def valid_rows(rows):
+    '''Validate rows, yields (group, computer id, computer) of all valid rows.'''
+    global resumed, skipped
+    for row, computer, group in rows:
+        # Rows added in a previous run are skipped with --resume
+        if (jss_client.normalize_key(args.key, computer), group) in done:
+            resumed += 1
+            continue
+        computer_id = check_row(computer, group)
+        if computer_id is None:
+            print('Skipping line: ' + ','.join(row))
+            log_row('skipped', computer, group)
+            skipped += 1
+            invalid_groups.add(group)
+        else:
+            yield group, computer_id, computer
+
+def desired_state(assignments):
+    '''--sync: collect the computers of all rows per group.
+
+    Returns an OrderedDict group -> OrderedDict computer id -> computer.
+    Groups with an invalid computer row are left out, a typo must never
+    remove a computer from a group.
+    '''
+    groups = OrderedDict()
+    for group, computer_id, computer in assignments:
+        groups.setdefault(group, OrderedDict())[computer_id] = computer
+    for group in invalid_groups.intersection(groups):
+        print('Not syncing group ' + group + ', it has invalid rows')
+        del groups[group]
+    return groups
+
+def batches(assignments, size):
+    '''Collect computers per group and yield (group, chunk) tuples.
+
+    A chunk is yielded as soon as it holds size computers, the rest of all
+    groups is yielded after the last row. Duplicate rows in a chunk are dropped.
+    '''
+    pending = OrderedDict()
+    for group, computer_id, computer in assignments:
+        chunk = pending.setdefault(group, OrderedDict())
+        chunk[computer_id] = computer
+        if len(chunk) >= size:
+            yield group, list(chunk.items())
+            del pending[group]
+    for group, chunk in pending.items():
+        yield group, list(chunk.items())
+
+def plan(assignments):
+    '''Print what a real run would do, nothing is sent to JSS.
+
+    Shows the computers and PUTs per group, the requests of the real run and
+    the estimated duration from the measured latencies.
+    '''
+    # writes collects group -> (computers, PUTs, changes according to the snapshot)
+    writes = OrderedDict()
+    already_member = 0
+    if args.sync:
+        # A sync sends at most one PUT per group, the changes are known with a membership snapshot
+        for group, desired in desired_state(assignments).items():
+            group_members = snapshot.members(group) if snapshot != None else None
+            if group_members != None:
+                additions = len([computer_id for computer_id in desired if computer_id not in group_members[0]])
+                deletions = len(group_members[0].difference(desired))
+                changes = ', ' + str(additions) + ' to add and ' + str(deletions) + ' to remove according to the snapshot'
+                writes[group] = (len(desired), 1 if additions + deletions > 0 else 0, changes)
+            else:
+                writes[group] = (len(desired), 1, '')
+    else:
+        for group, chunk in batches(assignments, args.chunk_size):
+            computers, puts, changes = writes.get(group, (0, 0, ''))
+            # With --idempotent and a membership snapshot we know which computers are sent
+            group_members = snapshot.members(group) if args.idempotent and snapshot != None else None
+            if group_members != None:
+                member_ids = group_members[0]
+                already_member += len([computer_id for computer_id, computer in chunk if computer_id in member_ids])
+                chunk = [(computer_id, computer) for computer_id, computer in chunk if computer_id not in member_ids]
+            writes[group] = (computers + len(chunk), puts + (1 if len(chunk) > 0 else 0), changes)
+    for group, (computers, puts, changes) in writes.items():
+        print('Group ' + group + ' (' + static_groups.get(group)[1] + '): ' +
+              str(computers) + ' computer(s) in ' + str(puts) + ' PUT(s)' + changes)
+    print(str(sum(computers for computers, puts, changes in writes.values())) + ' computer(s) in ' +
+          str(len(writes)) + ' group(s), ' + str(skipped) + ' invalid row(s) skipped')
+    if already_member:
+        print(str(already_member) + ' computer(s) are already members according to the snapshot')
+
+    # The real run loads the computer list, computergroups come from the cache
+    group_endpoint = jss_profile.endpoint('GET', jss_url + '/JSSResource/computergroups/id/0')
+    put_endpoint = jss_profile.endpoint('PUT', jss_url + '/JSSResource/computergroups/id/0')
+    planned = {jss_profile.endpoint('GET', jss_url + jss_client.computers_path(args.key)): 1}
+    if args.refresh:
+        planned[jss_profile.endpoint('GET', jss_url + '/JSSResource/computergroups')] = 1
+    planned[put_endpoint] = sum(puts for computers, puts, changes in writes.values())
+    # The PUTs of one group are sent one after the other
+    serial = {put_endpoint: max([puts for computers, puts, changes in writes.values()] or [0])}
+    # A sync and --idempotent always load the current members of every group from JSS
+    if args.sync or args.idempotent:
+        planned[group_endpoint] = len(writes)
+        serial[group_endpoint] = 1
+    # --verify loads the members of every group once more after the PUTs
+    if args.verify:
+        planned[group_endpoint] = planned.get(group_endpoint, 0) + len(writes)
+    latency = jss_profile.latencies()
+    if args.plan_trace != None:
+        latency.update(jss_profile.latencies(args.plan_trace))
+    jss_profile.print_estimate(planned, latency, args.workers, serial)
+
+def positive_int(value):
+    '''argparse type for --workers and --max-workers, the pool needs at least one thread.'''
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid int value: ' + repr(value))
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1: ' + value)
+    return number
+
 parser = argparse.ArgumentParser()
 parser.add_argument('filename', help="CSV file with [computers,id] to assign.")
+parser.add_argument('--key', choices=sorted(jss_client.COMPUTER_KEYS), default='name',
+                    help="Optional: The computers in the file are names, serial numbers, MAC addresses or UDIDs (default name).")
+parser.add_argument('--chunk-size', type=int, default=250,
+                    help="Optional: Maximum number of computers sent in one PUT per group (default 250).")
+parser.add_argument('-w', '--workers', type=positive_int, default=1,
+                    help="Optional: Number of parallel PUTs to JSS (default 1).")
+parser.add_argument('--adaptive', action="store_true",
+                    help="Optional: Start with WORKERS parallel requests and adapt them to the latency of JSS.")
+parser.add_argument('--max-workers', type=positive_int, default=16,
+                    help="Optional: With --adaptive never send more parallel requests (default 16).")
+parser.add_argument("--refresh", action="store_true",
+                    help="Optional: Ignore the local computergroups cache and reload it from JSS.")
+parser.add_argument('--idempotent', action="store_true",
+                    help="Optional: Load the members of every group once and only add missing computers.")
+parser.add_argument('--journal', type=str,
+                    help="Optional: Journal of the outcome of every row (default filename.journal).")
+parser.add_argument('--resume', action="store_true",
+                    help="Optional: Skip all rows that were added according to the journal.")
+parser.add_argument("--profile", type=str,
+                    help="Optional: Write a JSON trace with phase durations and request statistics to this file.")
+parser.add_argument('--sync', action="store_true",
+                    help="Optional: The file is the desired state, remove all other computers from the groups in the file.")
+parser.add_argument("--plan", action="store_true",
+                    help="Optional: Only print the planned PUTs per group, the requests and the estimated duration.")
+parser.add_argument("--plan-trace", type=str,
+                    help="Optional: Estimate the duration of --plan from the request latencies of a --profile trace.")
+parser.add_argument("--verify", action="store_true",
+                    help="Optional: Load the members of every updated group after the PUTs and report missing computers.")
 args = parser.parse_args()
 
-# In ci_list we fetch all lines in an array
-ci_list = []
+# Rows skipped by --resume would be removed from their groups
+if args.sync and args.resume:
+    print('--sync cannot be combined with --resume, a sync can simply be repeated')
+    sys.exit(1)
+
+# With --profile every request and the main phases are timed
+# --plan estimates the duration from the latency of the requests it makes
+if args.profile != None or args.plan:
+    jss_profile.enable(args.profile)
+
+if not os.path.isfile(args.filename):
+    print('No such file or directory: ' + args.filename)
+    sys.exit(1)
+
+# Every row is logged in the journal (one JSON object per line), failed rows
+# are written to filename.failed.csv which can be retried on its own
+if args.journal == None:
+    args.journal = args.filename + '.journal'
+done = set()
+if args.resume:
+    done = read_journal(args.journal)
+# In debug mode and with --plan nothing is sent, so we have nothing to log
+journal = None
+if not _debug and not args.plan:
+    journal = open(args.journal, 'a')
+journal_lock = threading.Lock()
+if not args.plan:
+    dead_letter_file = open(args.filename + '.failed.csv', 'w')
+    dead_letter = csv.writer(dead_letter_file)
+resumed = 0
+skipped = 0
+# Groups with invalid computer rows, --sync leaves them alone
+invalid_groups = set()
+
+# Session with one pooled keep-alive connection per worker, transient errors are retried
+# With --adaptive the pool has max_workers threads, the limiter of the session decides how many send
+if args.adaptive:
+    args.max_workers = max(args.max_workers, args.workers)
+else:
+    args.max_workers = args.workers
+# --verify loads the members of the groups in parallel, also with a single worker for the PUTs
+verify_workers = max(args.max_workers, jss_verify.DEFAULT_WORKERS)
+s = jss_client.JSSSession(pl, pool_size=verify_workers if args.verify else args.max_workers)
+pool = ThreadPool(args.max_workers)
+
+# Get all computergroups from the local cache or from jss
+jss_profile.start('load computergroups')
+computergroups = jss_cache.get_computergroups(s, jss_url, jss_cache_ttl, args.refresh)
+jss_profile.stop('load computergroups')
+
+# In static_groups we index all static groups from computegroups by id
+# we only assign to static groups
+jss_profile.start('group extraction')
+static_groups = jss_index.StaticGroupIndex(computergroups)
+jss_profile.stop('group extraction')
 
-if args.filename != None:
+# Resolve all computers from one listing instead of one GET per row
+jss_profile.start('load computers')
+computer_index = jss_client.get_computers(s, args.key)
+jss_profile.stop('load computers')
+
+# --plan shows the changes according to the membership snapshot (see snapshot.py) if there is one,
+# the real run always asks JSS before it skips a computer
+snapshot = None
+if args.plan and (args.idempotent or args.sync):
+    snapshot = jss_cache.get_snapshot(s, jss_url, [group[0] for group in static_groups], jss_cache_ttl)
+
+# --plan reads the whole file but sends nothing, invalid rows fail the plan
+if args.plan:
     try:
-        with open(args.filename, 'r') as csv_file:
-            for line in csv_file.readlines():
-                ci_list.append(line.strip('\r\n'))
+        plan(valid_rows(read_rows(args.filename)))
     except IOError:
-        print('No such file or directory: ' + args.filname)
+        print('No such file or directory: ' + args.filename)
         sys.exit(1)
+    if resumed:
+        print('Skipped ' + str(resumed) + ' row(s) already added in a previous run.')
+    sys.exit(1 if skipped else 0)
+
+# The rows stream through read_rows -> valid_rows -> batches, a chunk is
+# sent as soon as it is full while the rest of the file is still read
+# group_queues keeps the chunks not sent yet per group in the order the groups appear in the file,
+# draining the groups that have a drain_group() task
+group_queues = OrderedDict()
+draining = set()
+queue_lock = threading.Lock()
+report_lock = threading.Lock()
+# At most two chunks per worker wait in the pool, this keeps memory flat
+slots = threading.BoundedSemaphore(args.max_workers * 2)
+connection_lost = threading.Event()
+# With --idempotent the current members of every group, loaded by put_chunk
+members = {}
+# Computers reported as added per group (group -> computer id -> computer) for --verify
+expected = OrderedDict()
+failed = 0
+# Computers reported so far, for the status line
+progress = 0
 
-# Get all computergroups from jss
+# Add all computers of a static group with one (or a few chunked) PUT(s)
+# Different groups are updated in parallel, the chunks of a group one after the other by one task
+# A failed chunk does not stop the other chunks, we report every computer
+# The put loop phase is the time spent waiting for free workers
+# With --adaptive the parallel requests follow the latency of JSS from here on
+status = None
+if args.adaptive:
+    s.limiter = jss_client.AdaptiveLimiter(args.workers, args.max_workers)
+    status_finished = threading.Event()
+    if sys.stderr.isatty():
+        status = threading.Thread(target=show_status, args=(s.limiter, status_finished))
+        status.daemon = True
+        status.start()
+jss_profile.start('put loop')
+rows = jss_profile.timed_iter('csv load', read_rows(args.filename))
+rows = jss_profile.timed_iter('validation', valid_rows(rows))
 try:
-    response = s.get(jss_url + '/JSSResource/computergroups')
-except requests.exceptions.ProxyError:
-    print('Cannot connect to ' + jss_url + ' ProxyError .. exiting')
-    sys.exit(1)
-if response.status_code != requests.codes.ok:
-    print('Could not load computergroups, return code was: ' + str(response.status_code))
-
-computergroups = json.loads(response.content)
-
-# In static_groups we select all static groups from computegroups
-static_groups = []
-# Extract all static groups from computer groups, we only assign to static groups
-for value in computergroups['computer_groups']:
-    if value['is_smart'] == False:
-        static_groups.append(value['id'])
-
-for value in ci_list:
-    # Excel files have ';' as separator
-    if ';' in value:
-        computer = value.split(';')[0]
-        group = value.split(';')[1]
-    # Normal csv should have ',' as seperator
+    if args.sync:
+        # The desired state of a group is only known after the last row
+        for group, desired in desired_state(rows).items():
+            if connection_lost.is_set():
+                break
+            group_queues[group] = deque()
+            slots.acquire()
+            pool.apply_async(sync_group, (group, desired), callback=report_sync)
     else:
-        computer = value.split(',')[0]
-        group = value.split(',')[1]
-    if get_computer(computer) and get_software(group, static_groups):
-        # Add  computer to selected static group
-        # Change the header to xml as jss only accepts xml for put
-        s.headers.update({'content-type': 'application/xml'})
-        data = '<computer_group><computer_additions><computer><name>' + computer + '</name></computer></computer_additions></computer_group>'
-        group_url = jss_url + '/JSSResource/computergroups/id/' + group
-        if _debug:
-            print (group_url)
-            print (data)
-        else:
-            try:
-                response = s.put(url=group_url, data=data)
-            except requests.exceptions.ProxyError:
-                print('Cannot connect to ' + jss_url + ' ProxyError .. exiting')
-                sys.exit(1)
-            if response.status_code == 201:
-                print('Added ' + computer + ' to group with id: ' + str(group))
-            else:
-                print('Update for group ' + str(group) + ' failed with return code: ' + str(response.status_code))
-                sys.exit(response.status_code)
+        for group, chunk in jss_profile.timed_iter('batching', batches(rows, args.chunk_size)):
+            if connection_lost.is_set():
+                break
+            slots.acquire()
+            queue_chunk(group, chunk)
+except IOError:
+    print('No such file or directory: ' + args.filename)
+    sys.exit(1)
+pool.close()
+pool.join()
+jss_profile.stop('put loop')
+if args.adaptive:
+    status_finished.set()
+    if status is not None:
+        status.join()
+    print('Adaptive concurrency ended at ' + str(int(s.limiter.limit)) + ' of ' + str(args.max_workers) +
+          ', ' + str(s.limiter.errors) + ' overload error(s)')
+
+# Membership of the updated groups changed, the snapshot entries must be reloaded
+if not _debug:
+    jss_cache.invalidate_groups(jss_url, list(group_queues))
+
+# One GET per updated group, after a lost connection there is nothing to verify
+mismatches = 0
+if args.verify and not _debug and not connection_lost.is_set():
+    mismatches = jss_verify.verify(s, jss_url, expected, args.sync, verify_workers)
+
+if journal is not None:
+    journal.close()
+dead_letter_file.close()
+
+if resumed:
+    print('Skipped ' + str(resumed) + ' row(s) already added in a previous run.')
+
+if connection_lost.is_set():
+    if args.sync:
+        print('Cannot connect to ' + jss_url + ' .. exiting, rerun the sync to continue')
     else:
-        print('Skipping line: ' + str(value))
\ No newline at end of file
+        print('Cannot connect to ' + jss_url + ' .. exiting, rerun with --resume to continue')
+    sys.exit(1)
+
+if args.sync and (failed or skipped):
+    print(str(failed) + ' group(s) could not be synced, ' + str(skipped) + ' invalid row(s) skipped .. see above!')
+    if failed:
+        print('Rows of failed groups were written to ' + args.filename + '.failed.csv')
+    sys.exit(1)
+
+if failed:
+    print(str(failed) + ' computer(s) could not be added .. see above!')
+    print('Failed rows were written to ' + args.filename + '.failed.csv')
+    sys.exit(1)
+
+if mismatches:
+    print(str(mismatches) + ' mismatch(es) found by --verify .. see above!')
+    sys.exit(1)
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Manfred Roiger <manfred.roiger@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''c2sgd.py
+
+A long running version of c2sg.py for self service portals. The JSS session,
+the computergroups and the computer list stay in memory, so an assignment
+only costs the PUT. Assignments of the same static group that arrive within
+--window seconds are added with one PUT.
+
+Requests are accepted on a Unix socket, one JSON object per line:
+
+    {"computer": "mac00234", "group": "211"}
+
+and answered with one JSON object per line:
+
+    {"computer": "mac00234", "group": "211", "status": "added", "code": 201}
+
+status is added, failed or invalid (with a message). The daemon can also
+watch a drop directory for csv files with [computer,id] rows like the files
+of c2sg_bulk.py. Write the file with another extension and rename it to .csv
+when it is complete. The results are written to file.result (one JSON object
+per line) and the file is renamed to file.done.
+
+    usage: c2sgd.py [-h] [--socket SOCKET] [--drop-dir DROP_DIR]
+                    [--window WINDOW] [--send COMPUTER ID]
+'''
+
+import requests
+import json
+import sys
+import argparse
+import os
+import signal
+import socket
+import threading
+import time
+import jss_cache
+import jss_client
+import jss_index
+from collections import OrderedDict
+try:
+    from Queue import Queue
+    from SocketServer import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from queue import Queue
+    from socketserver import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+
+# Seconds between two scans of the drop directory
+POLL_INTERVAL = 1
+# An unknown computer reloads the computer list at most every RELOAD_INTERVAL seconds
+RELOAD_INTERVAL = 60
+
+# The connection settings are read from a JSON file:
+#   filename: ~//Library/Preferences/com.github.mvc2c.plist
+#   see jss_client.py for the dict with connection settings
+pl = jss_client.load_settings()
+
+# Full url i.e. https://jssserver.domain.com:8443
+jss_url = pl['jss_url']
+# Optional: Seconds the local computergroups cache is valid
+jss_cache_ttl = pl.get('jss_cache_ttl', jss_cache.DEFAULT_TTL)
+
+def put_computers(group, computers):
+    '''Add computers (dict id -> name) to a static group with one PUT, returns the status code.'''
+    data = '<computer_group><computer_additions>'
+    for computer_id in computers:
+        data += '<computer><id>' + str(computer_id) + '</id></computer>'
+    data += '</computer_additions></computer_group>'
+    response = s.put(url=jss_url + '/JSSResource/computergroups/id/' + group, data=data,
+                     headers={'content-type': 'application/xml'})
+    # Membership of the group changed, the snapshot entry must be reloaded
+    jss_cache.invalidate_groups(jss_url, [group])
+    return response.status_code
+
+
+class GroupCommitter(object):
+    '''Collect assignments per group and add them with one PUT after window seconds.
+
+    The first assignment of a group starts a timer, all assignments of the
+    group until it fires are sent together. PUTs of the same group never run
+    at the same time, a batch that is ready waits for the previous one. If
+    JSS rejects a batch, every computer of it is sent again with its own PUT,
+    so one bad computer does not fail the others.
+    '''
+
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        # group -> list of (computer id, computer, result dict, Event)
+        self.pending = {}
+        self.group_locks = {}
+
+    def submit(self, group, computer_id, computer):
+        '''Queue an assignment, returns (result dict, Event) set after the PUT.'''
+        waiter = ({'computer': computer, 'group': group}, threading.Event())
+        with self.lock:
+            if group not in self.pending:
+                self.pending[group] = []
+                timer = threading.Timer(self.window, self.flush, (group,))
+                timer.daemon = True
+                timer.start()
+            self.pending[group].append((computer_id, computer) + waiter)
+        return waiter
+
+    def flush(self, group):
+        '''Send all pending assignments of a group, runs in the timer thread.'''
+        with self.lock:
+            batch = self.pending.pop(group)
+            group_lock = self.group_locks.setdefault(group, threading.Lock())
+        computers = OrderedDict((computer_id, computer) for computer_id, computer, result, done in batch)
+        with group_lock:
+            status_code = self.put(group, computers)
+            if status_code == 201:
+                status_codes = dict.fromkeys(computers, status_code)
+                print('Added ' + str(len(computers)) + ' computer(s) to group with id: ' + group)
+            elif len(computers) > 1 and status_code != None:
+                print('Adding ' + str(len(computers)) + ' computer(s) to group ' + group +
+                      ' failed with return code: ' + str(status_code) + ', retrying one by one')
+                status_codes = {}
+                for computer_id, computer in computers.items():
+                    status_codes[computer_id] = self.put(group, OrderedDict([(computer_id, computer)]))
+                    if status_codes[computer_id] != 201:
+                        print('Adding ' + computer + ' to group ' + group + ' failed with return code: ' +
+                              str(status_codes[computer_id]))
+                added = list(status_codes.values()).count(201)
+                print('Added ' + str(added) + ' of ' + str(len(computers)) + ' computer(s) to group with id: ' + group)
+            else:
+                # JSS cannot be reached, single PUTs would fail the same way
+                status_codes = dict.fromkeys(computers, status_code)
+                print('Adding ' + str(len(computers)) + ' computer(s) to group ' + group +
+                      ' failed with return code: ' + str(status_code))
+        sys.stdout.flush()
+        for computer_id, computer, result, done in batch:
+            result['status'] = 'added' if status_codes[computer_id] == 201 else 'failed'
+            result['code'] = status_codes[computer_id]
+            done.set()
+
+    def put(self, group, computers):
+        '''put_computers(), None if JSS cannot be reached.'''
+        try:
+            return put_computers(group, computers)
+        except requests.exceptions.RequestException:
+            return None
+
+
+class Inventory(object):
+    '''Static groups and computer list kept in memory.
+
+    The computergroups are reloaded (usually from the local cache) when
+    they are older than the cache ttl, the computer list when an unknown
+    computer is requested, at most every RELOAD_INTERVAL seconds. If a
+    reload fails the old index is kept.
+
+    A reload builds the new index without holding a lock that check() of
+    other requests needs, the new index replaces the old one when it is
+    complete. Only requests for unknown computers wait for a running reload
+    of the computer list.
+    '''
+
+    def __init__(self):
+        self.groups_lock = threading.Lock()
+        self.computers_lock = threading.Lock()
+        self.groups_loaded = 0
+        self.computers_loaded = 0
+        self.load_groups()
+        self.load_computers()
+
+    def load_groups(self):
+        '''Load the static groups, raises jss_client.JSSError or a connection error.'''
+        self.static_groups = jss_index.StaticGroupIndex(jss_cache.load_computergroups(s, jss_url, jss_cache_ttl))
+        self.groups_loaded = time.time()
+
+    def load_computers(self):
+        '''Load the computer list, raises jss_client.JSSError or a connection error.'''
+        # A failed reload is not repeated for every request
+        self.computers_loaded = time.time()
+        self.computer_index = s.get_computers()
+
+    def reload_groups(self):
+        '''Reload the expired static groups, keep the old ones if JSS cannot be reached.
+
+        Requests that arrive while another one reloads use the old groups.
+        '''
+        if not self.groups_lock.acquire(False):
+            return
+        try:
+            if time.time() - self.groups_loaded > jss_cache_ttl:
+                self.load_groups()
+        except (requests.exceptions.RequestException, jss_client.JSSError) as error:
+            # Try again after RELOAD_INTERVAL seconds, not with every request
+            self.groups_loaded = time.time() - jss_cache_ttl + RELOAD_INTERVAL
+            print('Could not reload the computergroups, keeping the old ones: ' + str(error))
+            sys.stdout.flush()
+        finally:
+            self.groups_lock.release()
+
+    def reload_computers(self, name):
+        '''Reload the computer list for an unknown computer, returns the index to use.'''
+        with self.computers_lock:
+            # Another request may have reloaded it while we waited
+            if name not in self.computer_index and time.time() - self.computers_loaded > RELOAD_INTERVAL:
+                self.load_computers()
+            return self.computer_index
+
+    def check(self, computer, group):
+        '''Return (computer id, group id) or raise ValueError with the reason.
+
+        A failed reload of the computer list is raised (jss_client.JSSError
+        or a connection error), the old list is kept.
+        '''
+        if time.time() - self.groups_loaded > jss_cache_ttl:
+            self.reload_groups()
+        static_group = self.static_groups.get(group)
+        if static_group == None:
+            raise ValueError('No such static group: ' + group)
+        name = jss_client.normalize(computer)
+        computer_index = self.computer_index
+        if name not in computer_index and time.time() - self.computers_loaded > RELOAD_INTERVAL:
+            computer_index = self.reload_computers(name)
+        if name not in computer_index:
+            raise ValueError('No such computer: ' + computer)
+        if computer_index[name] == None:
+            raise ValueError('More than one computer has the name ' + computer)
+        return computer_index[name], str(static_group[0])
+
+
+def submit(computer, group):
+    '''Validate and queue one assignment, returns (result dict, Event).'''
+    try:
+        computer_id, group = inventory.check(computer.strip(), group.strip())
+    except ValueError as error:
+        done = threading.Event()
+        done.set()
+        return {'computer': computer, 'group': group, 'status': 'invalid', 'message': str(error)}, done
+    except requests.exceptions.RequestException:
+        done = threading.Event()
+        done.set()
+        return {'computer': computer, 'group': group, 'status': 'failed',
+                'message': 'Cannot connect to ' + jss_url}, done
+    except jss_client.JSSError as error:
+        done = threading.Event()
+        done.set()
+        return {'computer': computer, 'group': group, 'status': 'failed', 'message': str(error)}, done
+    return committer.submit(group, computer_id, computer)
+
+
+class AssignmentHandler(StreamRequestHandler):
+    '''One JSON assignment per line, answered with one JSON result per line.
+
+    All lines are queued as soon as they are read, so many assignments on
+    one connection share the PUTs. The results are written in order.
+    '''
+
+    def handle(self):
+        results = Queue()
+        writer = threading.Thread(target=self.write_results, args=(results,))
+        writer.start()
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            if line.strip() == b'':
+                continue
+            try:
+                assignment = json.loads(line.decode('utf-8'))
+                results.put(submit(assignment['computer'], str(assignment['group'])))
+            except (ValueError, KeyError, TypeError):
+                done = threading.Event()
+                done.set()
+                results.put(({'status': 'invalid', 'message': 'Expected {"computer": ..., "group": ...}'}, done))
+        results.put(None)
+        writer.join()
+
+    def write_results(self, results):
+        while True:
+            waiter = results.get()
+            if waiter is None:
+                return
+            result, done = waiter
+            done.wait()
+            try:
+                self.wfile.write((json.dumps(result) + '\n').encode('utf-8'))
+                self.wfile.flush()
+            except socket.error:
+                # The client is gone, the assignment was done anyway
+                pass
+
+
+class AssignmentServer(ThreadingMixIn, UnixStreamServer):
+    '''Threaded Unix socket server, one thread per connection.'''
+
+    daemon_threads = True
+
+
+def process_file(filename):
+    '''Queue all rows of a drop file (renamed to filename.processing), write the results to filename.result.
+
+    The result is always written and the file renamed to filename.done, a
+    file that cannot be read gets a failed entry.
+    '''
+    waiters = []
+    try:
+        with open(filename + '.processing', 'r') as csv_file:
+            for row in jss_client.read_csv(csv_file):
+                if len(row) == 0:
+                    continue
+                waiters.append(submit(row[0], row[1] if len(row) > 1 else ''))
+    except Exception as error:
+        # The file must never stay in .processing, the rows read so far are still reported
+        done = threading.Event()
+        done.set()
+        waiters.append(({'status': 'failed', 'message': 'Cannot read ' + filename + ': ' + str(error)}, done))
+    with open(filename + '.result', 'w') as result_file:
+        for result, done in waiters:
+            done.wait()
+            result_file.write(json.dumps(result) + '\n')
+    os.rename(filename + '.processing', filename + '.done')
+    print('Processed ' + filename + ' with ' + str(len(waiters)) + ' row(s)')
+    sys.stdout.flush()
+
+def watch(drop_dir):
+    '''Process every new csv file of the drop directory, files are handled in parallel.'''
+    while True:
+        for name in sorted(os.listdir(drop_dir)):
+            if name.endswith('.csv'):
+                filename = os.path.join(drop_dir, name)
+                # The rename marks the file as taken, the next scan does not see it again
+                os.rename(filename, filename + '.processing')
+                thread = threading.Thread(target=process_file, args=(filename,))
+                thread.daemon = True
+                thread.start()
+        time.sleep(POLL_INTERVAL)
+
+def send(socket_path, computer, group):
+    '''Client: send one assignment to a running daemon and print the result.'''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    client.sendall((json.dumps({'computer': computer, 'group': group}) + '\n').encode('utf-8'))
+    client.shutdown(socket.SHUT_WR)
+    answer = client.makefile('r').readline()
+    client.close()
+    if answer.strip() == '':
+        print('No answer from the daemon on ' + socket_path)
+        return False
+    print(answer.strip())
+    return json.loads(answer)['status'] == 'added'
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--socket', type=str,
+                    help="Optional: Unix socket for JSON assignment requests.")
+parser.add_argument('--drop-dir', type=str,
+                    help="Optional: Directory that is watched for csv files with [computer,id] rows.")
+parser.add_argument('--window', type=float, default=0.2,
+                    help="Optional: Seconds assignments of the same group are collected for one PUT (default 0.2).")
+parser.add_argument('--send', nargs=2, metavar=('COMPUTER', 'ID'),
+                    help="Optional: Send one assignment to the daemon listening on --socket and exit.")
+args = parser.parse_args()
+
+if args.socket == None and args.drop_dir == None:
+    print('Please provide --socket and/or --drop-dir')
+    sys.exit(1)
+
+if args.send != None:
+    if args.socket == None:
+        print('--send needs --socket')
+        sys.exit(1)
+    sys.exit(0 if send(args.socket, args.send[0], args.send[1]) else 1)
+
+if args.drop_dir != None and not os.path.isdir(args.drop_dir):
+    print('No such directory: ' + args.drop_dir)
+    sys.exit(1)
+
+# One warm session for all requests, transient errors are retried
+s = jss_client.JSSSession(pl)
+try:
+    inventory = Inventory()
+except requests.exceptions.ConnectionError:
+    print('Cannot connect to ' + jss_url + ' .. exiting')
+    sys.exit(1)
+except jss_client.JSSError as error:
+    print(str(error))
+    sys.exit(1)
+committer = GroupCommitter(args.window)
+print('Loaded ' + str(len(inventory.static_groups)) + ' static group(s) and ' +
+      str(len(inventory.computer_index)) + ' computer(s)')
+
+server = None
+if args.socket != None:
+    # A socket left over from a previous run is removed
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = AssignmentServer(args.socket, AssignmentHandler)
+    print('Listening on ' + args.socket)
+if args.drop_dir != None:
+    watcher = threading.Thread(target=watch, args=(args.drop_dir,))
+    watcher.daemon = True
+    watcher.start()
+    print('Watching ' + args.drop_dir)
+sys.stdout.flush()
+
+# SIGTERM (i.e. from launchd) stops the daemon like <Ctrl-C>
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+try:
+    if server != None:
+        server.serve_forever()
+    else:
+        while True:
+            time.sleep(POLL_INTERVAL)
+except KeyboardInterrupt:
+    pass
+finally:
+    if server != None:
+        server.server_close()
+        os.remove(args.socket)
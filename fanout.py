@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Manfred Roiger <manfred.roiger@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''fanout.py
+
+Run c2sg_bulk.py, mvc2c.py (with -m) or snapshot.py against several JSS
+instances at the same time. The targets are read from
+~/Library/Preferences/com.github.mvc2c.targets.plist (see jss_client.py),
+without -t the script runs against all of them:
+
+    fanout.py c2sg_bulk.py computers.csv --workers 4
+    fanout.py -t emea -t us mvc2c.py -m mapping.csv
+
+Every target runs as its own process with its own connection settings,
+session pool and cache (~/Library/Caches/com.github.mvc2c/<target>). Files
+given as arguments are copied to the report directory of the target, so
+the journal and the failed rows of c2sg_bulk.py are written per target.
+The output of a target is printed with its name as prefix and written to
+<report dir>/<target>/output.log. Use the same --report-dir to continue
+an interrupted run with --resume.
+
+    usage: fanout.py [-h] [-t TARGET] [--report-dir REPORT_DIR] [--list]
+                     [script] ...
+'''
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import jss_cache
+import jss_client
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Lines of the targets are printed as a whole
+print_lock = threading.Lock()
+
+
+def find_script(script):
+    '''Path of the script, relative to the working directory or to fanout.py.'''
+    for path in (script, os.path.join(HERE, script)):
+        if os.path.isfile(path):
+            return os.path.abspath(path)
+    return None
+
+
+def run_target(name, settings, script, script_args, report_dir, results):
+    '''Run the script against one target, stores (exit code, seconds) in results.'''
+    target_dir = os.path.join(report_dir, name)
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    argv = [sys.executable, script]
+    for arg in script_args:
+        if os.path.isfile(arg):
+            shutil.copy(arg, target_dir)
+            arg = os.path.basename(arg)
+        argv.append(arg)
+    # The password is only on disk while the script runs, mkstemp creates the file with mode 0600
+    fd, settings_file = tempfile.mkstemp(prefix='fanout', suffix='.json')
+    with os.fdopen(fd, 'w') as target_settings:
+        json.dump(settings, target_settings)
+    env = dict(os.environ, MVC2C_SETTINGS=settings_file, PYTHONUNBUFFERED='1',
+               MVC2C_CACHE_DIR=os.path.join(jss_cache.CACHE_DIR, name))
+    prefix = ('[' + name + '] ').encode('utf-8')
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    started = time.time()
+    try:
+        with open(os.devnull, 'r') as devnull:
+            with open(os.path.join(target_dir, 'output.log'), 'wb') as log:
+                process = subprocess.Popen(argv, cwd=target_dir, env=env, stdin=devnull,
+                                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                for line in iter(process.stdout.readline, b''):
+                    log.write(line)
+                    with print_lock:
+                        out.write(prefix + line)
+                        out.flush()
+                process.wait()
+    finally:
+        os.remove(settings_file)
+    results[name] = (process.returncode, time.time() - started)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-t', '--target', type=str, action='append',
+                    help="Optional: Only run against this target, can be repeated (default all targets).")
+parser.add_argument('--report-dir', type=str,
+                    help="Optional: Directory for the output and reports of the targets (default fanout-<date>-<time>).")
+parser.add_argument('--list', action="store_true",
+                    help="Optional: List the configured targets and exit.")
+parser.add_argument('script', nargs='?',
+                    help="c2sg_bulk.py, mvc2c.py or snapshot.py")
+parser.add_argument('script_args', nargs=argparse.REMAINDER,
+                    help="Arguments of the script.")
+args = parser.parse_args()
+
+try:
+    targets = jss_client.load_targets()
+except (IOError, OSError, ValueError) as e:
+    print('Cannot read the targets from ' + jss_client.TARGETS_FILE + ': ' + str(e))
+    sys.exit(1)
+
+if args.list:
+    for name in sorted(targets):
+        print('%-12s %s' % (name, targets[name]['jss_url']))
+    sys.exit(0)
+
+if args.script == None:
+    print('Please provide the script to run, i.e. fanout.py c2sg_bulk.py computers.csv')
+    sys.exit(1)
+script = find_script(args.script)
+if script == None:
+    print('No such script: ' + args.script)
+    sys.exit(1)
+
+if args.target == None:
+    selected = sorted(targets)
+else:
+    selected = []
+    for name in args.target:
+        if name not in targets:
+            print('No such target: ' + name + ', use --list to see all targets')
+            sys.exit(1)
+        if name not in selected:
+            selected.append(name)
+
+if args.report_dir == None:
+    args.report_dir = 'fanout-' + time.strftime('%Y%m%d-%H%M%S')
+
+# All targets run at the same time, the rollout takes as long as the slowest one
+started = time.time()
+results = {}
+threads = []
+for name in selected:
+    thread = threading.Thread(target=run_target,
+                              args=(name, targets[name], script, args.script_args, args.report_dir, results))
+    thread.start()
+    threads.append(thread)
+for thread in threads:
+    thread.join()
+
+print('')
+failed = 0
+for name in selected:
+    exit_code, seconds = results.get(name, (None, 0))
+    if exit_code == 0:
+        result = 'ok'
+    else:
+        result = 'failed (' + str(exit_code) + ')'
+        failed += 1
+    print('%-12s %-12s %7.1f s  %s' % (name, result, seconds, os.path.join(args.report_dir, name, 'output.log')))
+print('%d of %d target(s) succeeded in %.1f s' % (len(selected) - failed, len(selected), time.time() - started))
+if failed:
+    sys.exit(1)
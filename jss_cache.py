@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Manfred Roiger <manfred.roiger@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''jss_cache.py
+
+Local cache of the JSS computergroups list shared by c2sg.py, c2sg_bulk.py
+and mvc2c.py. The list (id, name, is_smart) is kept in a SQLite database:
+    ~/Library/Caches/com.github.mvc2c/jss_cache.sqlite
+
+The list is fetched again from JSS with one request when an entry is older
+than the ttl (seconds). Membership changes do not change the list, only
+renamed or new groups do.
+
+The same database holds an optional snapshot of the members of all static
+groups (see snapshot.py), indexed by computer name and id so the groups of
+a computer are found without asking JSS. Groups in the snapshot expire, the
+scripts invalidate the groups they updated, a few stale groups are
+reloaded one by one.
+'''
+
+import requests
+import json
+import os
+import sys
+import sqlite3
+import threading
+import time
+import jss_client
+import jss_profile
+import jss_stream
+from multiprocessing.pool import ThreadPool
+
+# Default time to live of cached entries in seconds
+DEFAULT_TTL = 3600
+
+# If more snapshot groups are stale the snapshot is not used, it must be reloaded with snapshot.py
+STALE_REFRESH_MAX = 20
+
+# Groups of the membership snapshot written per transaction
+SNAPSHOT_COMMIT = 100
+
+# The environment variable MVC2C_CACHE_DIR overrides the cache directory, i.e. for fanout.py
+CACHE_DIR = os.environ.get('MVC2C_CACHE_DIR', os.path.expanduser('~/Library/Caches/com.github.mvc2c'))
+
+
+def open_cache(cache_dir=None, check_same_thread=True):
+    '''Open (and create if needed) the cache database.'''
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    db = sqlite3.connect(os.path.join(cache_dir, 'jss_cache.sqlite'), check_same_thread=check_same_thread)
+    db.execute('CREATE TABLE IF NOT EXISTS computer_groups ('
+               'jss_url TEXT, id INTEGER, name TEXT, is_smart INTEGER, fetched REAL, '
+               'PRIMARY KEY (jss_url, id))')
+    db.execute('CREATE TABLE IF NOT EXISTS snapshot_groups ('
+               'jss_url TEXT, id INTEGER, fetched REAL, PRIMARY KEY (jss_url, id))')
+    db.execute('CREATE TABLE IF NOT EXISTS group_members ('
+               'jss_url TEXT, group_id INTEGER, computer_id INTEGER, computer_name TEXT, '
+               'PRIMARY KEY (jss_url, group_id, computer_id))')
+    # Reverse index computer -> groups
+    db.execute('CREATE INDEX IF NOT EXISTS group_members_name ON group_members (jss_url, computer_name)')
+    db.execute('CREATE INDEX IF NOT EXISTS group_members_id ON group_members (jss_url, computer_id)')
+    return db
+
+
+def fetch_computergroups(s, jss_url):
+    '''Get all computergroups from jss as list of (id, name, is_smart) tuples.
+
+    The listing is decoded while it is read, only the three fields of every
+    group are kept. Raises jss_client.JSSError for an unexpected return code,
+    connection errors are raised as well.
+    '''
+    response = s.get(jss_url + '/JSSResource/computergroups', stream=True)
+    if response.status_code != requests.codes.ok:
+        response.close()
+        raise jss_client.JSSError('Could not load computergroups, return code was: ' + str(response.status_code))
+    with jss_profile.phase('decode computergroups'):
+        return list(jss_stream.iter_listing(response, 'computer_groups', ('id', 'name', 'is_smart')))
+
+
+def get_computergroups(s, jss_url, ttl=DEFAULT_TTL, refresh=False, cache_dir=None):
+    '''Get all computergroups like load_computergroups(), exit if they cannot be loaded.'''
+    try:
+        return load_computergroups(s, jss_url, ttl, refresh, cache_dir)
+    except requests.exceptions.ConnectionError:
+        print('Cannot connect to ' + jss_url + ' .. exiting')
+        sys.exit(1)
+    except jss_client.JSSError as error:
+        print(str(error))
+        sys.exit(1)
+
+
+def load_computergroups(s, jss_url, ttl=DEFAULT_TTL, refresh=False, cache_dir=None):
+    '''Get all computergroups, from the cache if it is still valid.
+
+    Returns a list of (id, name, is_smart) tuples sorted by id.
+    With refresh=True the cache is bypassed and reloaded. Raises
+    jss_client.JSSError and connection errors, i.e. for c2sgd.py which must
+    keep running.
+    '''
+    db = open_cache(cache_dir)
+    now = time.time()
+    rows = db.execute('SELECT id, name, is_smart, fetched FROM computer_groups WHERE jss_url = ? ORDER BY id',
+                      (jss_url,)).fetchall()
+    expired = [row for row in rows if row[3] < now - ttl]
+    if not refresh and len(rows) > 0 and len(expired) == 0:
+        db.close()
+        return [(row[0], row[1], bool(row[2])) for row in rows]
+    # The listing is one request, cheaper than reloading expired groups one by one
+    try:
+        groups = fetch_computergroups(s, jss_url)
+        with db:
+            db.execute('DELETE FROM computer_groups WHERE jss_url = ?', (jss_url,))
+            db.executemany('INSERT INTO computer_groups VALUES (?, ?, ?, ?, ?)',
+                           [(jss_url, gid, name, int(is_smart), now) for gid, name, is_smart in groups])
+    finally:
+        db.close()
+    return sorted(groups)
+
+
+def invalidate_groups(jss_url, group_ids, cache_dir=None):
+    '''Mark the snapshot of the groups as stale after their members were updated.
+
+    The computergroups list (id, name, is_smart) does not change with the
+    members, its entries stay valid.
+    '''
+    db = open_cache(cache_dir)
+    group_ids = [(jss_url, int(gid)) for gid in group_ids]
+    with db:
+        db.executemany('UPDATE snapshot_groups SET fetched = 0 WHERE jss_url = ? AND id = ?', group_ids)
+    db.close()
+
+
+def fetch_members(s, jss_url, gid):
+    '''Get the members of a group, called from the worker threads of update_snapshot.
+
+    Returns (gid, status_code, list of (computer id, computer name)).
+    Connection errors are raised.
+    '''
+    response = s.get(jss_url + '/JSSResource/computergroups/id/' + str(gid))
+    if response.status_code != requests.codes.ok:
+        return gid, response.status_code, []
+    computers = json.loads(response.content)['computer_group']['computers']
+    return gid, response.status_code, [(computer['id'], computer['name']) for computer in computers]
+
+
+def load_members(s, jss_url, gid):
+    '''Get the current members of a static group from jss, never from the snapshot.
+
+    Returns a tuple (set of computer ids, set of normalized computer names)
+    or None if the group could not be loaded. Connection errors are raised,
+    this function is also called from worker threads.
+    '''
+    gid, status_code, computers = fetch_members(s, jss_url, gid)
+    if status_code != requests.codes.ok:
+        return None
+    return (set(computer_id for computer_id, name in computers),
+            set(jss_client.normalize(name) for computer_id, name in computers))
+
+
+def get_members(s, jss_url, gid):
+    '''Get the current members of a static group like load_members(), exit if JSS cannot be reached.'''
+    try:
+        return load_members(s, jss_url, gid)
+    except requests.exceptions.ConnectionError:
+        print('Cannot connect to ' + jss_url + ' .. exiting')
+        sys.exit(1)
+
+
+def update_snapshot(s, jss_url, group_ids, workers=8, cache_dir=None):
+    '''Reload the members of the groups in parallel and store them in the snapshot.
+
+    The requests run in workers threads, the results are written by the
+    calling thread. Groups that no longer exist are removed. Every stored
+    group is complete, after a connection error the snapshot can be
+    continued with the groups that are still stale.
+    Returns the list of group ids that could not be loaded.
+    '''
+    db = open_cache(cache_dir)
+    pool = ThreadPool(workers)
+    failed = []
+    try:
+        results = pool.imap_unordered(lambda gid: fetch_members(s, jss_url, gid), group_ids)
+        for count, (gid, status_code, computers) in enumerate(results):
+            if status_code not in (requests.codes.ok, requests.codes.not_found):
+                print('Could not load computergroup ' + str(gid) + ', return code was: ' + str(status_code))
+                failed.append(gid)
+                continue
+            db.execute('DELETE FROM group_members WHERE jss_url = ? AND group_id = ?', (jss_url, gid))
+            if status_code == requests.codes.not_found:
+                db.execute('DELETE FROM snapshot_groups WHERE jss_url = ? AND id = ?', (jss_url, gid))
+                continue
+            db.executemany('INSERT OR REPLACE INTO group_members VALUES (?, ?, ?, ?)',
+                           [(jss_url, gid, computer_id, jss_client.normalize(name))
+                            for computer_id, name in computers])
+            db.execute('INSERT OR REPLACE INTO snapshot_groups VALUES (?, ?, ?)', (jss_url, gid, time.time()))
+            # One transaction per group would be slow for thousands of groups
+            if count % SNAPSHOT_COMMIT == 0:
+                db.commit()
+    finally:
+        pool.terminate()
+        db.commit()
+        db.close()
+    return failed
+
+
+def stale_snapshot_groups(jss_url, group_ids, ttl=DEFAULT_TTL, cache_dir=None):
+    '''Return the group ids that are not in the snapshot, expired or invalidated.
+
+    Groups in the snapshot that are not in group_ids (deleted or no longer
+    static) are removed.
+    '''
+    db = open_cache(cache_dir)
+    wanted = set(int(gid) for gid in group_ids)
+    fetched = dict(db.execute('SELECT id, fetched FROM snapshot_groups WHERE jss_url = ?', (jss_url,)).fetchall())
+    removed = [(jss_url, gid) for gid in fetched if gid not in wanted]
+    if removed:
+        with db:
+            db.executemany('DELETE FROM group_members WHERE jss_url = ? AND group_id = ?', removed)
+            db.executemany('DELETE FROM snapshot_groups WHERE jss_url = ? AND id = ?', removed)
+    db.close()
+    now = time.time()
+    return sorted(gid for gid in wanted if fetched.get(gid, 0) < now - ttl)
+
+
+def get_snapshot(s, jss_url, group_ids, ttl=DEFAULT_TTL, cache_dir=None):
+    '''Return the MembershipSnapshot of the static groups group_ids or None.
+
+    None if there is no snapshot (it must be created with snapshot.py) or
+    if more than STALE_REFRESH_MAX groups are stale, a few stale groups are
+    reloaded. The callers then fall back to asking JSS.
+    '''
+    db = open_cache(cache_dir)
+    exists = db.execute('SELECT 1 FROM snapshot_groups WHERE jss_url = ? LIMIT 1', (jss_url,)).fetchone()
+    db.close()
+    if exists is None:
+        return None
+    stale = stale_snapshot_groups(jss_url, group_ids, ttl, cache_dir)
+    if len(stale) > STALE_REFRESH_MAX:
+        print('The membership snapshot is outdated, run snapshot.py to reload it')
+        return None
+    if len(stale) > 0:
+        try:
+            if update_snapshot(s, jss_url, stale, workers=min(len(stale), 4), cache_dir=cache_dir):
+                return None
+        except requests.exceptions.ConnectionError:
+            print('Cannot connect to ' + jss_url + ' .. exiting')
+            sys.exit(1)
+    return MembershipSnapshot(jss_url, cache_dir)
+
+
+class MembershipSnapshot(object):
+    '''Read access to the membership snapshot, safe to use from worker threads.'''
+
+    def __init__(self, jss_url, cache_dir=None):
+        self.jss_url = jss_url
+        self.db = open_cache(cache_dir, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    def groups_of(self, computer):
+        '''Return the ids of the static groups a computer (by name) is a member of.'''
+        with self.lock:
+            rows = self.db.execute('SELECT group_id FROM group_members WHERE jss_url = ? AND computer_name = ? '
+                                   'ORDER BY group_id', (self.jss_url, jss_client.normalize(computer))).fetchall()
+        return [row[0] for row in rows]
+
+    def groups_of_id(self, computer_id):
+        '''Return the ids of the static groups a computer (by id) is a member of.'''
+        with self.lock:
+            rows = self.db.execute('SELECT group_id FROM group_members WHERE jss_url = ? AND computer_id = ? '
+                                   'ORDER BY group_id', (self.jss_url, int(computer_id))).fetchall()
+        return [row[0] for row in rows]
+
+    def members(self, gid):
+        '''Return the members of a group like load_members(), None if it is not in the snapshot.'''
+        with self.lock:
+            if self.db.execute('SELECT 1 FROM snapshot_groups WHERE jss_url = ? AND id = ?',
+                               (self.jss_url, int(gid))).fetchone() is None:
+                return None
+            rows = self.db.execute('SELECT computer_id, computer_name FROM group_members '
+                                   'WHERE jss_url = ? AND group_id = ?', (self.jss_url, int(gid))).fetchall()
+        return set(row[0] for row in rows), set(row[1] for row in rows)
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Manfred Roiger <manfred.roiger@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''jss_client.py
+
+JSS connection shared by c2sg.py, c2sg_bulk.py and mvc2c.py.
+
+The connection settings must be provided in a JSON file:
+    filename: ~//Library/Preferences/com.github.mvc2c.plist
+    dict with connection settings:
+        {
+            'jss_pass':'yourPassword',
+            'jss_user':'yourUser',
+            'jss_url':'https://yourJSSUrl:8443',
+            'jss_verify':0,
+            'jss_warn':1
+        }
+    if your JSS has a self signed certificate set jsss_verify to 0 and jss_warn to 1
+    jss_url must be the full url including https:// and port i.e. :8443
+
+For fanout.py several JSS instances can be configured as named targets in
+a second JSON file, every target is a dict with connection settings:
+    filename: ~//Library/Preferences/com.github.mvc2c.targets.plist
+        {
+            'emea': {'jss_url':'https://jss-emea:8443', 'jss_user':..., ...},
+            'us': {'jss_url':'https://jss-us:8443', 'jss_user':..., ...}
+        }
+
+JSSSession keeps a pool of keep-alive connections. Idempotent requests (GET)
+are retried on connection errors and on 502, 503 and 504 with exponential
+backoff and jitter. A 429 (too many requests) is retried for every method,
+JSS did not process the request. A Retry-After header is respected.
+
+An AdaptiveLimiter can be attached to a JSSSession to limit the parallel
+requests of all threads, the limit follows the latency of JSS (AIMD).
+'''
+
+import requests
+from requests.packages import urllib3
+import csv
+import json
+import sys
+import getpass
+import os
+import random
+import re
+import threading
+import time
+import jss_profile
+import jss_stream
+
+# The environment variable MVC2C_SETTINGS overrides the settings file, i.e. for bench_jss.py
+SETTINGS_FILE = os.environ.get('MVC2C_SETTINGS',
+                               '/Users/' + getpass.getuser() + '/Library/Preferences/com.github.mvc2c.plist')
+# Named JSS targets for fanout.py, MVC2C_TARGETS overrides the file
+TARGETS_FILE = os.environ.get('MVC2C_TARGETS',
+                              '/Users/' + getpass.getuser() + '/Library/Preferences/com.github.mvc2c.targets.plist')
+
+# Number of retries after the first attempt
+RETRIES = 5
+# Backoff before retry n is a random time up to BACKOFF * 2 ** n seconds
+BACKOFF = 0.5
+# We never wait longer than BACKOFF_MAX seconds
+BACKOFF_MAX = 30
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+RETRY_STATUS = (502, 503, 504)
+TOO_MANY_REQUESTS = 429
+
+# AdaptiveLimiter: a latency above LATENCY_TOLERANCE * baseline means JSS is overloaded
+LATENCY_TOLERANCE = 2.0
+# The limit is multiplied by LIMIT_DECREASE on overload
+LIMIT_DECREASE = 0.5
+# Weight of a new request in the smoothed latency
+LATENCY_SMOOTHING = 0.2
+# At a limit of 1 the baseline slowly follows the latency, a JSS that stays slower
+# without our load becomes the new normal
+BASELINE_DRIFT = 0.05
+
+# Column types of computers in the csv files -> field in the computer listing
+COMPUTER_KEYS = {'name': 'name', 'serial': 'serial_number', 'mac': 'mac_address', 'udid': 'udid'}
+
+
+class JSSError(Exception):
+    '''JSS answered a request with an unexpected return code.'''
+
+
+def load_settings(filename=SETTINGS_FILE):
+    '''Read the connection settings from the JSON settings file.'''
+    with open(filename, 'r') as jss_settings:
+        return json.load(jss_settings)
+
+
+def load_targets(filename=TARGETS_FILE):
+    '''Read the named JSS targets, returns a dict name -> connection settings.'''
+    with open(filename, 'r') as jss_targets:
+        return json.load(jss_targets)
+
+
+def read_csv(csv_file):
+    '''Yield the rows of an open csv file as lists of fields.
+
+    The separator is sniffed from the start of the file, Excel files have
+    ';' as separator, normal csv files ','. A row that stays a single field
+    with the other separator in it (i.e. a ';' row in a ',' file) is split
+    on that one.
+    '''
+    sample = csv_file.read(4096)
+    csv_file.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;')
+    except csv.Error:
+        dialect = csv.excel
+    other = ';' if dialect.delimiter == ',' else ','
+    for row in csv.reader(csv_file, dialect):
+        if len(row) == 1 and other in row[0]:
+            row = row[0].split(other)
+        yield row
+
+
+def normalize(name):
+    '''Key for the computer index, JSS computer names are case insensitive.'''
+    return name.strip().lower()
+
+
+def normalize_key(key, value):
+    '''Key for the computer index of a column type, MAC addresses are compared without separators.'''
+    if key == 'mac':
+        return re.sub(r'[^0-9a-f]', '', value.lower())
+    return normalize(value)
+
+
+def computers_path(key='name'):
+    '''Path of the computer listing with the field of the column type.
+
+    The plain listing only has id and name, the basic subset of all
+    computers also has serial number, MAC address and UDID.
+    '''
+    if key == 'name':
+        return '/JSSResource/computers'
+    return '/JSSResource/computers/subset/basic'
+
+
+def find_computer(computer_index, key, computer):
+    '''Look up the id of a computer in an index of get_computers(key), None if it is not found.'''
+    value = normalize_key(key, computer)
+    if value not in computer_index:
+        print('No such computer: ' + computer)
+        return None
+    if computer_index[value] is None:
+        print('More than one computer has the ' + key + ' ' + computer)
+        return None
+    return computer_index[value]
+
+
+class AdaptiveLimiter(object):
+    '''Limit of parallel requests with additive increase, multiplicative decrease.
+
+    While the smoothed latency stays below LATENCY_TOLERANCE times the
+    baseline (the best latency seen) the limit grows by one per round of
+    limit requests. Rising latency, 429 and 5xx responses and connection
+    errors cut the limit by LIMIT_DECREASE, at most once per round trip so
+    a burst of errors counts once. The limit never exceeds ceiling.
+    '''
+
+    def __init__(self, initial, ceiling):
+        self.ceiling = max(1, ceiling)
+        self.limit = float(max(1, min(initial, self.ceiling)))
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.latency = None
+        self.baseline = None
+        self.last_decrease = 0
+        self.completed = 0
+        self.errors = 0
+
+    def acquire(self):
+        '''Wait until one more request is allowed.'''
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, seconds, status_code):
+        '''Report a finished request, status_code is None for a connection error.'''
+        with self.condition:
+            self.in_flight -= 1
+            self.completed += 1
+            error = status_code is None or status_code == TOO_MANY_REQUESTS or status_code >= 500
+            if error:
+                self.errors += 1
+            else:
+                if self.latency is None:
+                    self.latency = seconds
+                else:
+                    self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+                if self.baseline is None or self.latency < self.baseline:
+                    self.baseline = self.latency
+                elif self.limit < 2:
+                    self.baseline += BASELINE_DRIFT * (self.latency - self.baseline)
+            if error or self.latency > self.baseline * LATENCY_TOLERANCE:
+                now = time.time()
+                if now - self.last_decrease > (self.latency or 0):
+                    self.limit = max(1.0, self.limit * LIMIT_DECREASE)
+                    self.last_decrease = now
+            else:
+                self.limit = min(float(self.ceiling), self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+
+class JSSSession(requests.Session):
+    '''requests.Session for the JSS API with pooled connections and retries.'''
+
+    def __init__(self, settings, pool_size=10, retries=RETRIES):
+        requests.Session.__init__(self)
+        # Full url i.e. https://jssserver.domain.com:8443
+        self.jss_url = settings['jss_url']
+        # The user needs read access to computers and computergroups and update access to computergroups
+        self.auth = (settings['jss_user'], settings['jss_pass'])
+        self.headers.update({'Accept': 'application/json'})
+        # If set to False (0) we disable ssl verify for self signed certificates
+        self.verify = settings['jss_verify']
+        # If set to True (1) we disable warnigs for self signed certificates
+        if settings['jss_warn']:
+            urllib3.disable_warnings()
+        self.retries = retries
+        # Optional AdaptiveLimiter shared by all threads using this session
+        self.limiter = None
+        # One keep-alive connection per parallel request, requests default is 10
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        jss_profile.add_session(self)
+
+    def connections_opened(self):
+        '''Number of connections opened by the pools of this session.'''
+        count = 0
+        for adapter in set(self.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                count += pools[key].num_connections
+        return count
+
+    def backoff(self, attempt, response=None):
+        '''Sleep before the next attempt, honor a Retry-After header.'''
+        delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF * 2 ** attempt))
+        if response is not None:
+            try:
+                delay = min(BACKOFF_MAX, float(response.headers.get('Retry-After')))
+            except (TypeError, ValueError):
+                pass
+        time.sleep(delay)
+
+    def request(self, method, url, *args, **kwargs):
+        '''Send a request, retry transient errors with jittered exponential backoff.'''
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            limiter = self.limiter
+            if limiter is not None:
+                limiter.acquire()
+            started = time.time()
+            try:
+                response = requests.Session.request(self, method, url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if limiter is not None:
+                    limiter.release(time.time() - started, None)
+                jss_profile.record_request(method, url, time.time() - started, 0, 'error', 0, 0)
+                if not idempotent or attempt >= self.retries:
+                    raise
+                self.backoff(attempt)
+                attempt += 1
+                continue
+            except Exception:
+                # Never leak a slot of the limiter
+                if limiter is not None:
+                    limiter.release(time.time() - started, None)
+                raise
+            if limiter is not None:
+                limiter.release(time.time() - started, response.status_code)
+            if jss_profile.enabled():
+                self.profile(method, url, started, response, kwargs.get('data'), kwargs.get('stream'))
+            retry = response.status_code == TOO_MANY_REQUESTS or \
+                (idempotent and response.status_code in RETRY_STATUS)
+            if not retry or attempt >= self.retries:
+                return response
+            # A streamed body is not read, closing it gives the connection back to the pool
+            response.close()
+            self.backoff(attempt, response)
+            attempt += 1
+
+    def profile(self, method, url, started, response, data, stream):
+        '''Report a request to jss_profile, a streamed body is counted by jss_stream while it is read.'''
+        if stream:
+            received = 0
+        else:
+            received = len(response.content)
+        jss_profile.record_request(method, url, time.time() - started, response.elapsed.total_seconds(),
+                                   response.status_code, len(data or ''), received)
+
+    def get_computer(self, computer, subset='General', by='name'):
+        '''Get a subset of computer information by computer name (or id), None if the request fails.
+
+        Only the requested subset (i.e. General or GroupsAccounts) is transferred,
+        the full record of a computer with a large inventory has several hundred KB.
+        '''
+        response = self.get(self.jss_url + '/JSSResource/computers/' + by + '/' + str(computer) + '/subset/' + subset)
+        if response.status_code != requests.codes.ok:
+            print("Request " + str(computer) + " by " + by + " failed with return code: " + str(response.status_code))
+            return None
+        return json.loads(response.content)
+
+    def get_computers(self, key='name'):
+        '''Get the lightweight list of all computers with one request.
+
+        Returns a dict normalized key -> computer id, key is a column type
+        of COMPUTER_KEYS. A name, serial number, MAC address or UDID that
+        more than one computer has maps to None, it must not pick one of them.
+        Computers without a value are left out. The listing is decoded while
+        it is read, see jss_stream.py. Raises JSSError if the listing cannot
+        be loaded, connection errors are raised as well.
+        '''
+        response = self.get(self.jss_url + computers_path(key), stream=True)
+        if response.status_code != requests.codes.ok:
+            response.close()
+            raise JSSError('Could not load computers, return code was: ' + str(response.status_code))
+        with jss_profile.phase('decode computers'):
+            computer_index = {}
+            for cid, value in jss_stream.iter_listing(response, 'computers', ('id', COMPUTER_KEYS[key])):
+                value = normalize_key(key, value or '')
+                if value == '':
+                    continue
+                computer_index[value] = None if value in computer_index else cid
+        return computer_index
+
+
+def get_computer(s, computer, subset='General', debug=False):
+    '''Get a subset of computer information by name like JSSSession.get_computer(), exit if the request fails.'''
+    try:
+        content = s.get_computer(computer, subset)
+    except requests.exceptions.ConnectionError:
+        print('Cannot connect to ' + s.jss_url + ' .. exiting')
+        sys.exit(1)
+    if content == None:
+        sys.exit(1)
+    if debug and 'general' in content['computer']:
+        print(content['computer']['general']['id'])
+    return content
+
+
+def get_computers(s, key='name'):
+    '''Get the computer index like JSSSession.get_computers(), exit if it cannot be loaded.'''
+    try:
+        return s.get_computers(key)
+    except requests.exceptions.ConnectionError:
+        print('Cannot connect to ' + s.jss_url + ' .. exiting')
+        sys.exit(1)
+    except JSSError as error:
+        print(str(error))
+        sys.exit(1)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Manfred Roiger <manfred.roiger@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''jss_index.py
+
+Index of the JSS static computergroups. Groups are found by their exact id
+or by (part of) their name. For the name search every lowercased name is
+split in n-grams of up to three characters, a search term is matched against
+the groups that contain all n-grams of the term.
+'''
+
+# Longest n-gram we index, longer search terms use all their trigrams
+GRAM_SIZE = 3
+
+
+def ngrams(text, size):
+    '''Return the set of all substrings of text with the given size.'''
+    return set(text[i:i + size] for i in range(len(text) - size + 1))
+
+
+class StaticGroupIndex(object):
+    '''Static groups by id, by name and by n-grams of the lowercased name.
+
+    Groups are stored as (id, name) tuples, ids in by_id are strings because
+    the scripts read ids from the command line or a csv file.
+    '''
+
+    def __init__(self, computergroups):
+        '''computergroups is a list of (id, name, is_smart) tuples, see jss_cache.get_computergroups().'''
+        self.by_id = {}
+        self.by_name = {}
+        self.grams = {}
+        for gid, name, is_smart in computergroups:
+            # We only assign to static groups
+            if is_smart:
+                continue
+            group = (gid, name)
+            self.by_id[str(gid)] = group
+            self.by_name[name] = group
+            lowered = name.lower()
+            for size in range(1, GRAM_SIZE + 1):
+                for gram in ngrams(lowered, size):
+                    self.grams.setdefault(gram, set()).add(str(gid))
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        '''All groups sorted by id.'''
+        return iter(sorted(self.by_id.values()))
+
+    def get(self, gid):
+        '''Return the group with exactly this id or None.'''
+        return self.by_id.get(str(gid).strip())
+
+    def search(self, software):
+        '''Return all groups sorted by id whose name contains software (case insensitive).'''
+        software = software.lower()
+        if software == '':
+            return list(self)
+        size = min(len(software), GRAM_SIZE)
+        # Start with the rarest n-gram to keep the intersections small
+        postings = sorted((self.grams.get(gram, set()) for gram in ngrams(software, size)), key=len)
+        candidates = set(postings[0])
+        for ids in postings[1:]:
+            if not candidates:
+                break
+            candidates &= ids
+        # n-grams may match in a different order, check the candidates
+        return sorted(self.by_id[gid] for gid in candidates
+                      if software in self.by_id[gid][1].lower())
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Manfred Roiger <manfred.roiger@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''jss_profile.py
+
+Timing instrumentation for the --profile option of the scripts.
+
+Phases (i.e. csv load, validation, put loop) are timed with start() and
+stop(), phase() or timed_iter(), nested phases are subtracted so every phase
+reports only its own time. JSSSession reports every HTTP request with record_request().
+When profiling is enabled with a filename a JSON trace is written at exit:
+
+    {
+        "total": seconds,
+        "phases": {name: {"seconds": ..., "count": ...}},
+        "requests": {"count": ..., "bytes_sent": ..., "bytes_received": ...,
+                     "connections": ...},
+        "endpoints": {"GET /JSSResource/computergroups/id/<id>": {
+            "count": ..., "seconds": ..., "p50": ..., "p99": ...,
+            "server": ..., "bytes_received": ..., "status": {...},
+            "histogram_ms": {"<=1": ..., ...}}}
+    }
+
+"server" is the time until the response headers arrived. It includes the
+connection setup (DNS, TLS) of requests that opened a new connection, so it
+is not the processing time of JSS alone. The rest of "seconds" is the
+transfer of the body. The body of a streamed listing is read later, its
+time is counted in the decode phase and its bytes with record_received().
+"connections" counts the opened connections, with working keep-alive it
+stays close to the number of parallel requests.
+
+The --plan mode of the scripts uses latencies() and estimate() to turn the
+planned requests into an estimated duration, either from the requests the
+plan made itself or from the trace of a previous run.
+'''
+
+import atexit
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the latency histogram buckets in milliseconds
+HISTOGRAM_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+_enabled = False
+_started = time.time()
+_lock = threading.Lock()
+_local = threading.local()
+_phases = {}
+_endpoints = {}
+_sessions = []
+
+
+def enable(filename=None):
+    '''Start profiling, the trace is written to filename (if any) when the script exits.'''
+    global _enabled, _started
+    _enabled = True
+    _started = time.time()
+    if filename is not None:
+        atexit.register(write, filename)
+
+
+def enabled():
+    return _enabled
+
+
+def add_session(session):
+    '''Register a session, its opened connections are counted in the trace.'''
+    _sessions.append(session)
+
+
+def _stack():
+    '''Open phases of this thread, entries are [name, started, nested seconds].'''
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def start(name):
+    '''Start timing phase name, phases started later are nested.'''
+    if _enabled:
+        _stack().append([name, time.time(), 0.0])
+
+
+def stop(name):
+    '''Stop timing phase name, its time minus the time of nested phases is added.'''
+    if not _enabled:
+        return
+    stack = _stack()
+    name, started, nested = stack.pop()
+    duration = time.time() - started
+    with _lock:
+        entry = _phases.setdefault(name, {'seconds': 0.0, 'count': 0})
+        entry['seconds'] += duration - nested
+        entry['count'] += 1
+    if stack:
+        stack[-1][2] += duration
+
+
+@contextmanager
+def phase(name):
+    '''Time a block of code as phase name.'''
+    start(name)
+    try:
+        yield
+    finally:
+        stop(name)
+
+
+def timed_iter(name, iterable):
+    '''Yield from iterable, the time to produce the items is added to phase name.'''
+    iterator = iter(iterable)
+    while True:
+        start(name)
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            stop(name)
+        yield item
+
+
+def endpoint(method, url):
+    '''Method and path of an url with ids and names replaced by placeholders.'''
+    path = re.sub(r'^https?://[^/]+', '', url)
+    path = re.sub(r'/id/\d+', '/id/<id>', path)
+    path = re.sub(r'/(name|serialnumber|macaddress|udid)/[^/]+', r'/\1/<\1>', path)
+    return method.upper() + ' ' + path
+
+
+def record_request(method, url, seconds, server, status_code, sent, received):
+    '''Count one HTTP request of a JSSSession.'''
+    if not _enabled:
+        return
+    key = endpoint(method, url)
+    with _lock:
+        entry = _endpoints.setdefault(key, {'durations': [], 'server': 0.0, 'bytes_sent': 0,
+                                            'bytes_received': 0, 'status': {}})
+        entry['durations'].append(seconds)
+        entry['server'] += server
+        entry['bytes_sent'] += sent
+        entry['bytes_received'] += received
+        entry['status'][str(status_code)] = entry['status'].get(str(status_code), 0) + 1
+
+
+def record_received(method, url, received):
+    '''Add the bytes of a streamed body to the request counted with record_request().'''
+    if not _enabled:
+        return
+    key = endpoint(method, url)
+    with _lock:
+        if key in _endpoints:
+            _endpoints[key]['bytes_received'] += received
+
+
+def histogram(durations):
+    '''Count durations per bucket of HISTOGRAM_MS.'''
+    buckets = {}
+    for duration in durations:
+        ms = duration * 1000
+        for bound in HISTOGRAM_MS:
+            if ms <= bound:
+                label = '<=' + str(bound)
+                break
+        else:
+            label = '>' + str(HISTOGRAM_MS[-1])
+        buckets[label] = buckets.get(label, 0) + 1
+    return buckets
+
+
+def percentile(values, percent):
+    '''Nearest rank percentile of a list of numbers, 0 for an empty list.'''
+    if len(values) == 0:
+        return 0
+    ordered = sorted(values)
+    return ordered[int(round(percent / 100.0 * (len(ordered) - 1)))]
+
+
+def trace():
+    '''Return the collected measurements as dict.'''
+    with _lock:
+        endpoints = {}
+        for key, entry in _endpoints.items():
+            endpoints[key] = {'count': len(entry['durations']),
+                              'seconds': sum(entry['durations']),
+                              'server': entry['server'],
+                              'p50': percentile(entry['durations'], 50),
+                              'p99': percentile(entry['durations'], 99),
+                              'bytes_sent': entry['bytes_sent'],
+                              'bytes_received': entry['bytes_received'],
+                              'status': dict(entry['status']),
+                              'histogram_ms': histogram(entry['durations'])}
+        phases = dict((name, dict(entry)) for name, entry in _phases.items())
+    return {'total': time.time() - _started,
+            'phases': phases,
+            'requests': {'count': sum(entry['count'] for entry in endpoints.values()),
+                         'bytes_sent': sum(entry['bytes_sent'] for entry in endpoints.values()),
+                         'bytes_received': sum(entry['bytes_received'] for entry in endpoints.values()),
+                         'connections': sum(session.connections_opened() for session in _sessions)},
+            'endpoints': endpoints}
+
+
+def latencies(filename=None):
+    '''Mean seconds per request of every endpoint.
+
+    Without filename the requests of this run are used, otherwise the
+    endpoints of a trace written by a previous run with --profile.
+    '''
+    if filename is None:
+        endpoints = trace()['endpoints']
+    else:
+        with open(filename, 'r') as trace_file:
+            endpoints = json.load(trace_file)['endpoints']
+    return dict((key, entry['seconds'] / entry['count'])
+                for key, entry in endpoints.items() if entry['count'] > 0)
+
+
+def estimate(planned, latency, workers=1, serial=None):
+    '''Estimated seconds for the planned requests (endpoint -> count).
+
+    The requests are spread over workers. serial (endpoint -> count) are
+    requests that run one after the other (i.e. the PUTs of the biggest
+    group), the estimate is never shorter. The latency of another endpoint
+    says nothing about a PUT, so seconds is None if a planned endpoint has
+    no measured latency. Returns (seconds, unmeasured endpoints).
+    '''
+    unmeasured = sorted(key for key, count in planned.items() if count > 0 and key not in latency)
+    if unmeasured:
+        return None, unmeasured
+    seconds = sum(count * latency[key] for key, count in planned.items() if count > 0)
+    seconds = seconds / max(workers, 1)
+    if serial:
+        seconds = max(seconds, sum(count * latency[key] for key, count in serial.items() if count > 0))
+    return seconds, unmeasured
+
+
+def print_estimate(planned, latency, workers=1, serial=None):
+    '''Print the planned requests per endpoint and the estimated duration.'''
+    for key in sorted(planned):
+        print('%8d %s' % (planned[key], key))
+    print('%8d requests' % sum(planned.values()))
+    seconds, unmeasured = estimate(planned, latency, workers, serial)
+    if unmeasured:
+        print('No estimated duration, no measured latency for ' + ', '.join(unmeasured) + '.')
+        print('Use --plan-trace with a --profile trace of a previous run for an estimate.')
+    else:
+        print('Estimated duration: %.1f s with %d worker(s)' % (seconds, workers))
+
+
+def write(filename):
+    '''Write the trace as JSON file, phases left open by sys.exit() are stopped.'''
+    while _stack():
+        stop(_stack()[-1][0])
+    with open(filename, 'w') as trace_file:
+        json.dump(trace(), trace_file, indent=2, sort_keys=True)
+    print('Profile written to ' + filename)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Manfred Roiger <manfred.roiger@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''jss_stream.py
+
+Streaming decoder for the large JSS listings (/JSSResource/computers and
+/JSSResource/computergroups). json.loads() on the full body keeps the raw
+bytes, the decoded text and the complete object tree in memory at the same
+time. iter_listing() reads the body of a streamed response in chunks and
+decodes only the complete elements of the listing in every chunk, only the
+requested fields of every element are kept as a tuple:
+
+    response = s.get(jss_url + '/JSSResource/computergroups', stream=True)
+    for gid, name, is_smart in iter_listing(response, 'computer_groups', ('id', 'name', 'is_smart')):
+        ...
+
+The elements of the listing must be JSON objects, which is what JSS returns.
+'''
+
+import codecs
+import json
+import re
+import jss_profile
+
+# Bytes read from the connection at once
+CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'\s*')
+# Separator after an element of the list
+_separator = re.compile(r'\s*([,\]])\s*')
+
+
+def _chunks(response):
+    '''Decoded text of the response body in chunks, gzip is handled by urllib3.
+
+    The bytes read are reported to jss_profile, Content-Length is missing
+    for a chunked response.
+    '''
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+    received = 0
+    while True:
+        data = response.raw.read(CHUNK_SIZE, decode_content=True)
+        if not data:
+            break
+        received += len(data)
+        yield decoder.decode(data)
+    jss_profile.record_received(response.request.method, response.url, received)
+    yield decoder.decode(b'', True)
+
+
+def _decode_elements(buf, pos):
+    '''Decode the complete elements of the list in buf from pos, returns (values, end).
+
+    The text up to the last closing brace is decoded with one call as a list,
+    if it is valid JSON it can only contain complete elements. The last brace
+    may close the document, so the one before is tried too. Otherwise a
+    single element is decoded, ValueError means it is incomplete.
+    '''
+    end = buf.rfind('}', pos)
+    for attempt in range(2):
+        if end < pos:
+            break
+        try:
+            return _decoder.decode(u'[' + buf[pos:end + 1] + u']'), end + 1
+        except ValueError:
+            end = buf.rfind('}', pos, end)
+    value, end = _decoder.raw_decode(buf, pos)
+    return [value], end
+
+
+def iter_listing(response, key, fields):
+    '''Yield a tuple of fields for every object in the list key of a streamed response.
+
+    Missing fields are None. The body is read until the end, so the
+    connection goes back to the pool. Raises ValueError if the body is not
+    a JSON object with the list key.
+    '''
+    try:
+        chunks = _chunks(response)
+        start = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+        buf = u''
+        # Skip everything before the list
+        for chunk in chunks:
+            buf += chunk
+            match = start.search(buf)
+            if match is not None:
+                break
+        else:
+            raise ValueError('No list ' + key + ' in response')
+        buf = buf[match.end():]
+        pos = 0
+        first = True
+        while True:
+            try:
+                values, end = _decode_elements(buf, pos)
+            except ValueError:
+                # The next element is incomplete (or the list is empty), read more
+                pos = _whitespace.match(buf, pos).end()
+                if first and buf.startswith(']', pos):
+                    break
+                chunk = next(chunks, None)
+                if chunk is None:
+                    raise
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            separator = _separator.match(buf, end)
+            while separator is None:
+                if _whitespace.match(buf, end).end() < len(buf):
+                    raise ValueError('Expected , or ] in list ' + key + ' at: ' + buf[end:end + 20])
+                chunk = next(chunks, None)
+                if chunk is None:
+                    raise ValueError('Unexpected end of list ' + key)
+                buf = buf[end:] + chunk
+                end = 0
+                separator = _separator.match(buf, end)
+            for value in values:
+                yield tuple(map(value.get, fields))
+            if separator.group(1) == ']':
+                break
+            pos = separator.end()
+            first = False
+        # The rest is only the closing brace
+        for chunk in chunks:
+            pass
+    finally:
+        response.close()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Manfred Roiger <manfred.roiger@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''jss_verify.py
+
+The --verify stage of c2sg_bulk.py and mvc2c.py. After the PUTs the members
+of every touched group are loaded once (in parallel) and the computers that
+were reported as added are checked against them as a set. The cost is one
+GET per group, not one request per computer. Only mismatches are printed:
+
+    Group 211: 2 of 250 computer(s) missing: mac00234, mac00333
+    Group 300: could not be verified, return code was: 404
+    Verified 1250 computer(s) in 5 group(s): 2 missing, 0 unexpected, 1 group(s) not verified
+'''
+
+import requests
+import jss_cache
+import jss_profile
+from multiprocessing.pool import ThreadPool
+
+# Parallel GETs of the group members
+DEFAULT_WORKERS = 8
+
+# Computers listed per group and problem, the rest is only counted
+REPORT_MAX = 10
+
+
+def fetch(s, jss_url, gid):
+    '''Members of a group in a worker thread, status_code is None for a connection error.'''
+    try:
+        return jss_cache.fetch_members(s, jss_url, gid)
+    except requests.exceptions.RequestException:
+        return gid, None, []
+
+
+def names(computers):
+    '''The first REPORT_MAX computers of a list for the report.'''
+    listed = ', '.join(computers[:REPORT_MAX])
+    if len(computers) > REPORT_MAX:
+        listed += ' and ' + str(len(computers) - REPORT_MAX) + ' more'
+    return listed
+
+
+def verify(s, jss_url, expected, exact=False, workers=DEFAULT_WORKERS):
+    '''Check the members of the touched groups in JSS, prints a mismatch report.
+
+    expected is a dict group id -> dict computer id -> computer (as it was
+    reported) of all computers that must be members. With exact (--sync) all
+    other members of a group are reported as unexpected.
+    Returns the number of mismatches, a group that cannot be loaded counts as one.
+    '''
+    if len(expected) == 0:
+        return 0
+    missing = 0
+    unexpected = 0
+    not_verified = 0
+    pool = ThreadPool(max(1, min(workers, len(expected))))
+    jss_profile.start('verify')
+    try:
+        # imap keeps the report in the order of the groups
+        for gid, status_code, members in pool.imap(lambda gid: fetch(s, jss_url, gid), list(expected)):
+            if status_code != requests.codes.ok:
+                if status_code is None:
+                    print('Group ' + str(gid) + ': could not be verified, cannot connect to ' + jss_url)
+                else:
+                    print('Group ' + str(gid) + ': could not be verified, return code was: ' + str(status_code))
+                not_verified += 1
+                continue
+            computers = expected[gid]
+            member_ids = set(computer_id for computer_id, name in members)
+            absent = [computers[computer_id] for computer_id in computers if computer_id not in member_ids]
+            if absent:
+                print('Group ' + str(gid) + ': ' + str(len(absent)) + ' of ' + str(len(computers)) +
+                      ' computer(s) missing: ' + names(absent))
+                missing += len(absent)
+            if exact:
+                extra = sorted(name for computer_id, name in members if computer_id not in computers)
+                if extra:
+                    print('Group ' + str(gid) + ': ' + str(len(extra)) + ' computer(s) should have been removed: ' +
+                          names(extra))
+                    unexpected += len(extra)
+    finally:
+        pool.terminate()
+        jss_profile.stop('verify')
+    print('Verified ' + str(sum(len(computers) for computers in expected.values())) + ' computer(s) in ' +
+          str(len(expected)) + ' group(s): ' + str(missing) + ' missing, ' + str(unexpected) + ' unexpected, ' +
+          str(not_verified) + ' group(s) not verified')
+    return missing + unexpected + not_verified
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Manfred Roiger <manfred.roiger@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''mock_jss.py
+
+A local stand-in for the JSS endpoints used by the scripts, so performance
+changes can be measured without touching a production JSS:
+
+    GET /JSSResource/computers
+    GET /JSSResource/computers/subset/basic
+    GET /JSSResource/computers/name/<name>[/subset/<subset>]
+    GET /JSSResource/computers/id/<id>[/subset/<subset>]
+    GET /JSSResource/computergroups
+    GET /JSSResource/computergroups/id/<id>
+    PUT /JSSResource/computergroups/id/<id>
+
+The synthetic inventory has computers mac00001 .. macNNNNN (with serial
+number, MAC address and UDID derived from the id) and groups with
+the names 'Software 1' .. 'Software N', every smart_every-th group is smart.
+Static groups start with group_size members. Latency, the extra time a PUT
+needs per group member (JSS rewrites the whole group) and the rate of
+injected 503 errors are configurable. With a capacity only that many
+requests are processed at the same time, like the worker threads of a
+Tomcat, the others wait and get slower.
+
+    usage: mock_jss.py [-h] [--port PORT] [--computers COMPUTERS]
+                       [--groups GROUPS] [--group-size GROUP_SIZE]
+                       [--latency LATENCY] [--member-latency MEMBER_LATENCY]
+                       [--error-rate ERROR_RATE] [--capacity CAPACITY]
+'''
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote
+
+
+def computer_name(computer_id):
+    '''Name of a synthetic computer.'''
+    return 'mac%05d' % computer_id
+
+
+def computer_basic(computer_id, name):
+    '''Record of a synthetic computer in the basic subset of the computer listing.'''
+    return {'id': computer_id, 'name': name,
+            'serial_number': 'C02%07d' % computer_id,
+            'mac_address': '00:1A:2B:%02X:%02X:%02X' % (computer_id >> 16 & 255, computer_id >> 8 & 255,
+                                                        computer_id & 255),
+            'udid': '%08X-0000-4000-8000-%012X' % (computer_id, computer_id)}
+
+
+def group_name(group_id):
+    '''Name of a synthetic computergroup.'''
+    return 'Software %d' % group_id
+
+
+class MockJSS(object):
+    '''In memory inventory of computers and computergroups with request statistics.'''
+
+    def __init__(self, computers=10000, groups=5000, group_size=20, smart_every=5,
+                 latency=0.0, member_latency=0.0, error_rate=0.0, seed=1, capacity=0):
+        self.latency = latency
+        self.member_latency = member_latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Requests processed at the same time, None for no limit
+        self.capacity = threading.Semaphore(capacity) if capacity > 0 else None
+        self.computers = dict((i, computer_name(i)) for i in range(1, computers + 1))
+        self.computer_ids = dict((name.lower(), i) for i, name in self.computers.items())
+        self.groups = {}
+        # Reverse index computer id -> set of group ids
+        self.memberships = dict((i, set()) for i in self.computers)
+        for gid in range(1, groups + 1):
+            is_smart = smart_every > 0 and gid % smart_every == 0
+            members = set()
+            if computers > 0:
+                members = set(self.random.randint(1, computers) for i in range(group_size))
+            self.groups[gid] = {'name': group_name(gid), 'is_smart': is_smart, 'members': members}
+            for computer_id in members:
+                self.memberships[computer_id].add(gid)
+        self.reset_stats()
+
+    def reset_stats(self):
+        '''Forget all request statistics.'''
+        with self.lock:
+            self.started = time.time()
+            # endpoint -> list of request durations in seconds
+            self.durations = {}
+            self.bytes_sent = 0
+            self.bytes_received = 0
+            self.errors = 0
+
+    def record(self, endpoint, duration, sent, received):
+        '''Count one request with its duration and size.'''
+        with self.lock:
+            self.durations.setdefault(endpoint, []).append(duration)
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def stats(self):
+        '''Return request statistics (counts, latency percentiles, bytes).'''
+        with self.lock:
+            endpoints = {}
+            all_durations = []
+            for endpoint, durations in self.durations.items():
+                endpoints[endpoint] = {'requests': len(durations),
+                                       'p50': percentile(durations, 50),
+                                       'p99': percentile(durations, 99)}
+                all_durations.extend(durations)
+            elapsed = time.time() - self.started
+            return {'requests': len(all_durations),
+                    'errors': self.errors,
+                    'elapsed': elapsed,
+                    'requests_per_second': len(all_durations) / elapsed if elapsed > 0 else 0,
+                    'p50': percentile(all_durations, 50),
+                    'p99': percentile(all_durations, 99),
+                    'bytes_sent': self.bytes_sent,
+                    'bytes_received': self.bytes_received,
+                    'endpoints': endpoints}
+
+    def inject_error(self):
+        '''True if this request should fail with a 503.'''
+        if self.error_rate <= 0:
+            return False
+        with self.lock:
+            if self.random.random() < self.error_rate:
+                self.errors += 1
+                return True
+        return False
+
+    def get(self, path):
+        '''Return (status, endpoint, body) for a GET request.'''
+        if path == '/JSSResource/computers':
+            with self.lock:
+                computers = [{'id': i, 'name': name} for i, name in sorted(self.computers.items())]
+            return 200, 'GET /computers', {'computers': computers}
+        if path == '/JSSResource/computers/subset/basic':
+            with self.lock:
+                computers = [computer_basic(i, name) for i, name in sorted(self.computers.items())]
+            return 200, 'GET /computers/subset/basic', {'computers': computers}
+        if path == '/JSSResource/computergroups':
+            with self.lock:
+                groups = [{'id': gid, 'name': group['name'], 'is_smart': group['is_smart']}
+                          for gid, group in sorted(self.groups.items())]
+            return 200, 'GET /computergroups', {'computer_groups': groups}
+        match = re.match(r'^/JSSResource/computergroups/id/(\d+)$', path)
+        if match:
+            with self.lock:
+                group = self.groups.get(int(match.group(1)))
+                if group is None:
+                    return 404, 'GET /computergroups/id', None
+                computers = [{'id': i, 'name': self.computers[i]} for i in sorted(group['members'])]
+                return 200, 'GET /computergroups/id', {'computer_group': {
+                    'id': int(match.group(1)), 'name': group['name'],
+                    'is_smart': group['is_smart'], 'computers': computers}}
+        match = re.match(r'^/JSSResource/computers/(name|id)/([^/]+)(?:/subset/([^/]+))?$', path)
+        if match:
+            endpoint = 'GET /computers/' + match.group(1)
+            subsets = (match.group(3) or 'General&GroupsAccounts').lower().split('&')
+            with self.lock:
+                if match.group(1) == 'name':
+                    computer_id = self.computer_ids.get(unquote(match.group(2)).lower())
+                else:
+                    computer_id = int(match.group(2)) if match.group(2).isdigit() else None
+                if computer_id not in self.computers:
+                    return 404, endpoint, None
+                computer = {}
+                if 'general' in subsets:
+                    computer['general'] = {'id': computer_id, 'name': self.computers[computer_id]}
+                if 'groupsaccounts' in subsets:
+                    computer['groups_accounts'] = {'computer_group_memberships': sorted(
+                        self.groups[gid]['name'] for gid in self.memberships[computer_id])}
+            return 200, endpoint, {'computer': computer}
+        return 404, 'GET other', None
+
+    def put(self, path, body):
+        '''Return (status, endpoint, delay) for a PUT request, apply additions and deletions.'''
+        match = re.match(r'^/JSSResource/computergroups/id/(\d+)$', path)
+        if not match:
+            return 404, 'PUT other', 0
+        gid = int(match.group(1))
+        try:
+            root = ElementTree.fromstring(body)
+        except ElementTree.ParseError:
+            return 400, 'PUT /computergroups/id', 0
+        with self.lock:
+            group = self.groups.get(gid)
+            if group is None:
+                return 404, 'PUT /computergroups/id', 0
+            if group['is_smart']:
+                return 409, 'PUT /computergroups/id', 0
+            for tag, add in (('computer_additions', True), ('computer_deletions', False)):
+                for computer in root.findall(tag + '/computer'):
+                    computer_id = self.resolve(computer)
+                    if computer_id is None:
+                        return 409, 'PUT /computergroups/id', 0
+                    if add:
+                        group['members'].add(computer_id)
+                        self.memberships[computer_id].add(gid)
+                    else:
+                        group['members'].discard(computer_id)
+                        self.memberships[computer_id].discard(gid)
+            # JSS rewrites the whole group, bigger groups are slower
+            delay = self.member_latency * len(group['members'])
+        return 201, 'PUT /computergroups/id', delay
+
+    def resolve(self, computer):
+        '''Computer id of a <computer> element with <id> or <name>.'''
+        if computer.findtext('id'):
+            computer_id = int(computer.findtext('id'))
+            return computer_id if computer_id in self.computers else None
+        return self.computer_ids.get((computer.findtext('name') or '').lower())
+
+
+def percentile(values, percent):
+    '''Nearest rank percentile of a list of numbers, 0 for an empty list.'''
+    if len(values) == 0:
+        return 0
+    ordered = sorted(values)
+    rank = int(round(percent / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+class MockJSSHandler(BaseHTTPRequestHandler):
+    '''HTTP/1.1 keep-alive handler that serves the MockJSS of the server.'''
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, without this every keep-alive
+    # request waits for the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        started = time.time()
+        jss = self.server.jss
+        if jss.inject_error():
+            return self.respond(started, 'GET error', 503, None)
+        if jss.capacity is not None:
+            jss.capacity.acquire()
+        try:
+            status, endpoint, body = jss.get(self.path)
+            time.sleep(jss.latency)
+        finally:
+            if jss.capacity is not None:
+                jss.capacity.release()
+        self.respond(started, endpoint, status, body)
+
+    def do_PUT(self):
+        started = time.time()
+        jss = self.server.jss
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if jss.inject_error():
+            return self.respond(started, 'PUT error', 503, None, length)
+        if jss.capacity is not None:
+            jss.capacity.acquire()
+        try:
+            status, endpoint, delay = jss.put(self.path, body)
+            time.sleep(jss.latency + delay)
+        finally:
+            if jss.capacity is not None:
+                jss.capacity.release()
+        self.respond(started, endpoint, status, None, length)
+
+    def respond(self, started, endpoint, status, body, received=0):
+        content = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        self.server.jss.record(endpoint, time.time() - started, len(content), received)
+
+
+class MockJSSServer(ThreadingMixIn, HTTPServer):
+    '''Threaded HTTP server, one thread per connection.'''
+
+    daemon_threads = True
+
+    def __init__(self, jss, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), MockJSSHandler)
+        self.jss = jss
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        '''Serve in a background thread.'''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def add_arguments(parser):
+    '''Options of the synthetic JSS, shared with bench_jss.py.'''
+    parser.add_argument('--computers', type=int, default=10000,
+                        help="Optional: Number of computers (default 10000).")
+    parser.add_argument('--groups', type=int, default=5000,
+                        help="Optional: Number of computergroups (default 5000).")
+    parser.add_argument('--group-size', type=int, default=20,
+                        help="Optional: Initial members of every static group (default 20).")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Optional: Seconds every request takes (default 0).")
+    parser.add_argument('--member-latency', type=float, default=0.0,
+                        help="Optional: Extra seconds a PUT takes per group member (default 0).")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Optional: Fraction of requests that fail with 503 (default 0).")
+    parser.add_argument('--capacity', type=int, default=0,
+                        help="Optional: Requests processed at the same time, 0 for no limit (default 0).")
+
+
+def from_arguments(args):
+    '''Build a MockJSS from parsed options.'''
+    return MockJSS(computers=args.computers, groups=args.groups, group_size=args.group_size,
+                   latency=args.latency, member_latency=args.member_latency,
+                   error_rate=args.error_rate, capacity=args.capacity)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080,
+                        help="Optional: Port to listen on (default 8080).")
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = MockJSSServer(from_arguments(args), args.port)
+    print('Mock JSS listening on ' + server.url + ', hit <Ctrl-C> to stop')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.jss.stats(), indent=2, sort_keys=True))
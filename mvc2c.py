@@ -19,71 +19,326 @@
 A litte utility to "move" software from one computer to another computer.
 To prevent weird results or corruption of the JSS database
 we only use assignments to static computer groups.
+
+With --key the mapping file has serial numbers, MAC addresses or UDIDs
+instead of computer names. With --verify the members of every updated group
+are loaded once after a migration and all destinations are checked.
 '''
 
 import requests
-from requests.packages import urllib3
 import json
 import sys
 import argparse
-import getpass
+import os
+import jss_cache
+import jss_client
+import jss_index
+import jss_profile
+import jss_verify
+from collections import OrderedDict
 
 # Set this flag to True to enable print output of various intermediate results
 _debug = False
 
-# The connection settings must be provided in a JSON file:
+# The connection settings are read from a JSON file:
 #   filename: ~//Library/Preferences/com.github.mvc2c.plist
-#   dict with connection settings:
-#       {
-#           'jss_pass':'yourPassword',
-#           'jss_user':'yourUser',
-#           'jss_url':'https://yourJSSUrl:8443',
-#           'jss_verify':0,
-#           'jss_warn':1
-#       }
-#       if your JSS has a self signed certificate set jsss_verify to 0 and jss_warn to 1
-#       jss_url must be the full url including https:// and port i.e. :8443
-logged_in_user = getpass.getuser()
-with open('/Users/' + logged_in_user + '/Library/Preferences/com.github.mvc2c.plist', 'r') as jss_settings:
-    pl = json.load(jss_settings)
+#   see jss_client.py for the dict with connection settings
+pl = jss_client.load_settings()
 
+# Full url i.e. https://jssserver.domain.com:8443
 jss_url = pl['jss_url']
-jss_user = pl['jss_user']
-jss_pass = pl['jss_pass']
-jss_warn = pl['jss_warn'] # If set to True (1) we disable warnigs for self signed certificates
-jss_verify = pl['jss_verify'] # If set to False (0) we disable ssl verify for self signed certificates
+# Optional: Seconds the local computergroups cache is valid
+jss_cache_ttl = pl.get('jss_cache_ttl', jss_cache.DEFAULT_TTL)
 
-if jss_warn:
-    urllib3.disable_warnings()
+# Session with pooled keep-alive connections, transient errors are retried
+s = jss_client.JSSSession(pl)
 
-s = requests.Session()
-s.auth = (jss_user, jss_pass)
-s.headers.update({'Accept': 'application/json'})
-s.verify = jss_verify
+def get_group_memberships(computer_id):
+    '''Get the computer_group_memberships of a computer by id, None if the request fails.
 
-def get_computer(computer):
-    '''Get full set of computer information that can be retrieved by computer name!'''
+    With a membership snapshot the names of its static groups are returned
+    without a request.
+    '''
+    if snapshot != None:
+        return group_names(snapshot.groups_of_id(computer_id))
     try:
-        response = s.get(jss_url + '/JSSResource/computers/name/' + computer)
-    except requests.exceptions.ProxyError:
-        print('Cannot connect to ' + jss_url + ' ProxyError .. exiting')
+        content = s.get_computer(computer_id, 'GroupsAccounts', by='id')
+    except requests.exceptions.ConnectionError:
+        print('Cannot connect to ' + jss_url + ' .. exiting')
+        sys.exit(1)
+    if content == None:
+        return None
+    return content['computer']['groups_accounts']['computer_group_memberships']
+
+def read_mapping(filename):
+    '''Yield (source, destination) for every row of a mapping csv file.'''
+    with open(filename, 'r') as csv_file:
+        for row in jss_client.read_csv(csv_file):
+            if len(row) < 2:
+                if len(row) > 0:
+                    print('Skipping line: ' + ','.join(row))
+                continue
+            yield row[0].strip(), row[1].strip()
+
+def group_names(group_ids):
+    '''Names of static groups by id, groups that are gone are left out.'''
+    return [static_groups.get(gid)[1] for gid in group_ids if static_groups.get(gid) != None]
+
+def snapshot_memberships(computer):
+    '''Names of the static groups of a computer (by name) from the membership snapshot.'''
+    return group_names(snapshot.groups_of(computer))
+
+
+def static_group_overlap(computer_group_memberships):
+    '''Return the static groups (id, name) sorted by id a computer is a member of.'''
+    overlap = static_group_names.intersection(computer_group_memberships)
+    return sorted(static_groups.by_name[name] for name in overlap)
+
+def put_group(group, computers):
+    '''Add computers (dict id -> name) to a static group with one PUT.'''
+    data = '<computer_group><computer_additions>'
+    for computer_id in computers:
+        data += '<computer><id>' + str(computer_id) + '</id></computer>'
+    data += '</computer_additions></computer_group>'
+    group_url = jss_url + '/JSSResource/computergroups/id/' + str(group)
+    if _debug:
+        print (group_url)
+        print (data)
+        return 201
+    try:
+        response = s.put(url=group_url, data=data, headers={'content-type': 'application/xml'})
+    except requests.exceptions.ConnectionError:
+        print('Cannot connect to ' + jss_url + ' .. exiting')
+        sys.exit(1)
+    # Membership of the group changed, the snapshot entry must be reloaded
+    jss_cache.invalidate_groups(jss_url, [group])
+    return response.status_code
+
+def collect_additions(mapping, computer_index):
+    '''Collect the destinations of a mapping file per static group of their sources.
+
+    Returns (OrderedDict group id -> OrderedDict destination id -> name,
+    number of skipped mappings).
+    '''
+    additions = OrderedDict()
+    skipped = 0
+    jss_profile.start('lookup sources')
+    for source_computer, dest_computer in read_mapping(mapping):
+        # Look up both so every problem of a mapping is printed
+        source_id = jss_client.find_computer(computer_index, args.key, source_computer)
+        dest_id = jss_client.find_computer(computer_index, args.key, dest_computer)
+        if source_id == None or dest_id == None:
+            print('Skipping ' + source_computer + ' -> ' + dest_computer)
+            skipped += 1
+            continue
+        computer_group_memberships = get_group_memberships(source_id)
+        if computer_group_memberships == None:
+            print('Skipping ' + source_computer + ' -> ' + dest_computer)
+            skipped += 1
+            continue
+        group_overlap = static_group_overlap(computer_group_memberships)
+        if len(group_overlap) == 0:
+            print(source_computer + ' has no mebership in static groups!')
+            continue
+        for group in group_overlap:
+            additions.setdefault(group[0], OrderedDict())[dest_id] = dest_computer
+    jss_profile.stop('lookup sources')
+    return additions, skipped
+
+def migrate(mapping):
+    '''Batch mode: add all destinations of a mapping file to the static groups of their sources.
+
+    Destinations are resolved from one computer listing, the static groups of
+    every source are matched with a set intersection and all destinations
+    of a group are added with one PUT per group.
+    '''
+    if not os.path.isfile(mapping):
+        print('No such file or directory: ' + mapping)
+        sys.exit(1)
+    with jss_profile.phase('load computers'):
+        computer_index = jss_client.get_computers(s, args.key)
+    additions, skipped = collect_additions(mapping, computer_index)
+
+    failed = 0
+    # Destinations per group that must be members for --verify
+    expected = OrderedDict()
+    jss_profile.start('put loop')
+    for group, computers in additions.items():
+        destinations = OrderedDict(computers)
+        if args.idempotent:
+            group_members = jss_cache.get_members(s, jss_url, group)
+            if group_members != None:
+                for computer_id in group_members[0].intersection(computers):
+                    print(computers.pop(computer_id) + ' is already a member of group with id: ' + str(group))
+            if len(computers) == 0:
+                expected[group] = destinations
+                continue
+        status_code = put_group(group, computers)
+        if status_code == 201:
+            expected[group] = destinations
+        for dest_computer in computers.values():
+            if status_code == 201:
+                print('Added ' + dest_computer + ' to group with id: ' + str(group))
+            else:
+                print('Adding ' + dest_computer + ' to group ' + str(group) + ' failed with return code: ' + str(status_code))
+                failed += 1
+
+    jss_profile.stop('put loop')
+
+    # One GET per updated group
+    mismatches = 0
+    if args.verify and not _debug:
+        mismatches = jss_verify.verify(s, jss_url, expected)
+
+    if skipped or failed:
+        print(str(skipped) + ' mapping(s) skipped, ' + str(failed) + ' addition(s) failed .. see above!')
+        sys.exit(1)
+    if mismatches:
+        print(str(mismatches) + ' mismatch(es) found by --verify .. see above!')
         sys.exit(1)
-    if response.status_code != requests.codes.ok:
-        print("Request " + computer + " by name failed with return code: " + str(response.status_code))
-        sys.exit(response.status_code)
+
+def plan(mapping):
+    '''Print what a migration of a mapping file would do, nothing is sent to JSS.
+
+    Sources and destinations are checked against the computer list.
+    With a membership snapshot the plan shows the additions per group.
+    Without it the static groups of a source are only known after the GET
+    of its memberships, the plan counts these GETs, the PUTs (one per static
+    group of the sources) are not part of the estimate.
+    '''
+    if not os.path.isfile(mapping):
+        print('No such file or directory: ' + mapping)
+        sys.exit(1)
+    computer_index = jss_client.get_computers(s, args.key)
+    if snapshot != None:
+        plan_additions(mapping, computer_index)
+        return
+    sources = 0
+    skipped = 0
+    for source_computer, dest_computer in read_mapping(mapping):
+        source_id = jss_client.find_computer(computer_index, args.key, source_computer)
+        dest_id = jss_client.find_computer(computer_index, args.key, dest_computer)
+        if source_id == None or dest_id == None:
+            print('Skipping ' + source_computer + ' -> ' + dest_computer)
+            skipped += 1
+            continue
+        sources += 1
+    print(str(sources) + ' mapping(s) to migrate, ' + str(skipped) + ' mapping(s) skipped')
+
+    planned = {jss_profile.endpoint('GET', jss_url + jss_client.computers_path(args.key)): 1,
+               jss_profile.endpoint('GET', jss_url + '/JSSResource/computers/id/0/subset/GroupsAccounts'): sources}
+    if args.refresh:
+        planned[jss_profile.endpoint('GET', jss_url + '/JSSResource/computergroups')] = 1
+    latency = jss_profile.latencies()
+    if args.plan_trace != None:
+        latency.update(jss_profile.latencies(args.plan_trace))
+    jss_profile.print_estimate(planned, latency)
+    if args.verify:
+        print('Plus one PUT and one GET (--verify) per static group of the sources.')
     else:
-        content = json.loads(response.content)
-        if _debug:
-            print(content['computer']['general']['id'])
-        return content
+        print('Plus one PUT per static group of the sources.')
+    if skipped:
+        sys.exit(1)
+
+def plan_additions(mapping, computer_index):
+    '''--plan with a membership snapshot, prints the additions per group.'''
+    additions, skipped = collect_additions(mapping, computer_index)
+    puts = 0
+    for group, computers in additions.items():
+        already_member = 0
+        if args.idempotent:
+            group_members = snapshot.members(group)
+            if group_members != None:
+                already_member = len(group_members[0].intersection(computers))
+        print('Group ' + str(group) + ' (' + static_groups.get(group)[1] + '): ' +
+              str(len(computers) - already_member) + ' computer(s) to add, ' +
+              str(already_member) + ' already member(s)')
+        if len(computers) > already_member:
+            puts += 1
+    print(str(len(additions)) + ' group(s), ' + str(skipped) + ' mapping(s) skipped')
+
+    planned = {jss_profile.endpoint('GET', jss_url + jss_client.computers_path(args.key)): 1,
+               jss_profile.endpoint('PUT', jss_url + '/JSSResource/computergroups/id/0'): puts}
+    # --idempotent loads the current members of every group, --verify once more after the PUTs
+    group_gets = len(additions) * (int(args.idempotent) + int(args.verify))
+    if group_gets:
+        planned[jss_profile.endpoint('GET', jss_url + '/JSSResource/computergroups/id/0')] = group_gets
+    if args.refresh:
+        planned[jss_profile.endpoint('GET', jss_url + '/JSSResource/computergroups')] = 1
+    latency = jss_profile.latencies()
+    if args.plan_trace != None:
+        latency.update(jss_profile.latencies(args.plan_trace))
+    jss_profile.print_estimate(planned, latency)
+    if skipped:
+        sys.exit(1)
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-s", "--source", type=str,
                     help="Optional: Name of a source computer to read computergroup memberships.")
 parser.add_argument("-d", "--destination", type=str,
                     help="Optional: Name of a destination computer that will be assigned to matching static computergroups.")
+parser.add_argument("-m", "--mapping", type=str,
+                    help="Optional: CSV file with [source,destination] pairs to migrate in one run. -s and -d are ignored.")
+parser.add_argument("--key", choices=sorted(jss_client.COMPUTER_KEYS), default='name',
+                    help="Optional: The computers in the mapping file are names, serial numbers, MAC addresses or UDIDs (default name).")
+parser.add_argument("--refresh", action="store_true",
+                    help="Optional: Ignore the local computergroups cache and reload it from JSS.")
+parser.add_argument("--idempotent", action="store_true",
+                    help="Optional: Only add the destination computer to groups it is not yet a member of.")
+parser.add_argument("--profile", type=str,
+                    help="Optional: Write a JSON trace with phase durations and request statistics to this file.")
+parser.add_argument("--plan", action="store_true",
+                    help="Optional: Only check the mapping file and print the requests and the estimated duration.")
+parser.add_argument("--plan-trace", type=str,
+                    help="Optional: Estimate the duration of --plan from the request latencies of a --profile trace.")
+parser.add_argument("--verify", action="store_true",
+                    help="Optional: Load the members of every updated group after the migration and report missing computers.")
 args = parser.parse_args()
 
+if args.plan and args.mapping == None:
+    print('--plan needs a mapping file (-m)')
+    sys.exit(1)
+
+if args.verify and args.mapping == None:
+    print('--verify needs a mapping file (-m)')
+    sys.exit(1)
+
+# -s and -d are looked up by name
+if args.key != 'name' and args.mapping == None:
+    print('--key needs a mapping file (-m)')
+    sys.exit(1)
+
+# With --profile every request and the main phases are timed
+# --plan estimates the duration from the latency of the requests it makes
+if args.profile != None or args.plan:
+    jss_profile.enable(args.profile)
+
+# Get all computer groups from the local cache or from jss
+jss_profile.start('load computergroups')
+computergroups = jss_cache.get_computergroups(s, jss_url, jss_cache_ttl, args.refresh)
+jss_profile.stop('load computergroups')
+if _debug:
+    print(json.dumps(computergroups, indent=2, sort_keys=True))
+
+# Index all static groups from computer groups by name, we only assign to static groups
+jss_profile.start('group extraction')
+static_groups = jss_index.StaticGroupIndex(computergroups)
+static_group_names = set(static_groups.by_name)
+jss_profile.stop('group extraction')
+
+if _debug:
+    print(list(static_groups))
+
+# The static groups of a computer come from the membership snapshot (see snapshot.py) if there is one
+snapshot = jss_cache.get_snapshot(s, jss_url, [group[0] for group in static_groups], jss_cache_ttl)
+
+if args.mapping != None:
+    if args.plan:
+        plan(args.mapping)
+    else:
+        migrate(args.mapping)
+    sys.exit(0)
+
 if args.source != None:
     source_computer = args.source
 else:
@@ -94,51 +349,48 @@ if args.destination != None:
 else:
     dest_computer = raw_input('Enter destination computer: ')
 
-# We need the groups_accounts subset of the computer dictionary
-groups_accounts = get_computer(source_computer)
+# We need the computer_group_memberships of the source computer in a list, from
+# the snapshot or from the groups_accounts subset of the computer dictionary
+jss_profile.start('lookup computers')
+if snapshot != None:
+    jss_client.get_computer(s, source_computer, debug=_debug)
+    computer_group_memberships = snapshot_memberships(source_computer)
+else:
+    groups_accounts = jss_client.get_computer(s, source_computer, 'GroupsAccounts', debug=_debug)
+    computer_group_memberships = groups_accounts['computer']['groups_accounts']['computer_group_memberships']
 
-# Just check if computer exists we don't need the content
-get_computer(dest_computer)
+# Check if computer exists, with --idempotent we also need its current group memberships from JSS
+dest_group_memberships = []
+if args.idempotent:
+    dest_groups_accounts = jss_client.get_computer(s, dest_computer, 'GroupsAccounts', debug=_debug)
+    dest_group_memberships = dest_groups_accounts['computer']['groups_accounts']['computer_group_memberships']
+else:
+    jss_client.get_computer(s, dest_computer, debug=_debug)
+jss_profile.stop('lookup computers')
 
-# Extract the computer_group_memberships in a list
-computer_group_memberships = groups_accounts['computer']['groups_accounts']['computer_group_memberships']
 if _debug:
     print(json.dumps(computer_group_memberships, indent=2, sort_keys=True))
 
-# Get all computer groups from jss
-try:
-    response = s.get(jss_url + '/JSSResource/computergroups')
-except requests.exceptions.ProxyError:
-    print('Cannot connect to ' + jss_url + ' ProxyError .. exiting')
-    sys.exit(1)
-if response.status_code != requests.codes.ok:
-    print(response.status_code)
-
-computergroups = json.loads(response.content)
-if _debug:
-    print(json.dumps(computergroups, indent=2, sort_keys=True))
-
-static_groups = []
-
-# Extract all static groups from computer groups, we only assign to static groups
-for value in computergroups['computer_groups']:
-    if value['is_smart'] == False:
-        static_groups.append([value['id'], value['name']])
-
-if _debug:
-    print(static_groups)
-
 group_overlap = []
 
+# With --idempotent we skip groups the destination computer is already a member of
+already_member = 0
+
 # Search fpr matches of static groups in group memberships of source computer
-for group in static_groups:
-    if group[1] in computer_group_memberships:
-        group_overlap.append(group[0])
-        if _debug:
-            print(group[1])
+for group in static_group_overlap(computer_group_memberships):
+    if group[1] in dest_group_memberships:
+        print(dest_computer + ' is already a member of group with id: ' + str(group[0]))
+        already_member += 1
+        continue
+    group_overlap.append(group[0])
+    if _debug:
+        print(group[1])
 
 # Check if we have anything to do
 if len(group_overlap) == 0:
+    if already_member > 0:
+        print(dest_computer + ' is already a member of all static groups of ' + source_computer)
+        sys.exit(0)
     print(source_computer + ' has no mebership in static groups!')
     sys.exit(1)
 
@@ -147,6 +399,7 @@ if len(group_overlap) == 0:
 s.headers.update({'content-type': 'application/xml'})
 data = '<computer_group><computer_additions><computer><name>' + dest_computer + '</name></computer></computer_additions></computer_group>'
 
+jss_profile.start('put loop')
 for group in group_overlap:
     group_url = jss_url + '/JSSResource/computergroups/id/' + str(group)
     if _debug:
@@ -154,11 +407,14 @@ for group in group_overlap:
     else:
         try:
             response = s.put(url=group_url, data=data)
-        except requests.exceptions.ProxyError:
-            print('Cannot connect to ' + jss_url + ' ProxyError .. exiting')
+        except requests.exceptions.ConnectionError:
+            print('Cannot connect to ' + jss_url + ' .. exiting')
             sys.exit(1)
+        # Membership of the group changed, the snapshot entry must be reloaded
+        jss_cache.invalidate_groups(jss_url, [group])
         if response.status_code == 201:
             print('Added ' + dest_computer + ' to group with id: ' + str(group))
         else:
             print('Update for group ' + str(group) + ' failed with return code: ' + str(response.status_code))
             sys.exit(response.status_code)
+jss_profile.stop('put loop')
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2017 Manfred Roiger <manfred.roiger@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''snapshot.py
+
+Load the members of all static computergroups into the local cache, so
+mvc2c.py, c2sg.py and c2sg_bulk.py know the group memberships of a computer
+without asking JSS. The members of the groups are loaded in parallel.
+
+Without options only groups that are new, expired or were changed by one
+of the scripts are reloaded. With -c the static groups of computers are
+printed from the snapshot.
+
+    usage: snapshot.py [-h] [-w WORKERS] [-g GROUP] [--full] [--refresh]
+                       [-c COMPUTER]
+'''
+
+import requests
+import sys
+import argparse
+import time
+import jss_cache
+import jss_client
+import jss_index
+
+# The connection settings are read from a JSON file:
+#   filename: ~//Library/Preferences/com.github.mvc2c.plist
+#   see jss_client.py for the dict with connection settings
+pl = jss_client.load_settings()
+
+# Full url i.e. https://jssserver.domain.com:8443
+jss_url = pl['jss_url']
+# Optional: Seconds the local computergroups cache (and the snapshot) is valid
+jss_cache_ttl = pl.get('jss_cache_ttl', jss_cache.DEFAULT_TTL)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-w', '--workers', type=int, default=8,
+                    help="Optional: Number of parallel requests to JSS (default 8).")
+parser.add_argument('-g', '--group', type=str, action='append',
+                    help="Optional: Only reload the static group with this id, can be repeated.")
+parser.add_argument('--full', action="store_true",
+                    help="Optional: Reload all static groups, not only the stale ones.")
+parser.add_argument("--refresh", action="store_true",
+                    help="Optional: Ignore the local computergroups cache and reload it from JSS.")
+parser.add_argument('-c', '--computer', type=str, action='append',
+                    help="Optional: Print the static groups of this computer from the snapshot, can be repeated.")
+args = parser.parse_args()
+
+# Session with one pooled keep-alive connection per worker, transient errors are retried
+s = jss_client.JSSSession(pl, pool_size=args.workers)
+
+computergroups = jss_cache.get_computergroups(s, jss_url, jss_cache_ttl, args.refresh)
+static_groups = jss_index.StaticGroupIndex(computergroups)
+group_ids = [group[0] for group in static_groups]
+
+# Find the groups to reload, this also drops groups that are gone from the snapshot
+stale = jss_cache.stale_snapshot_groups(jss_url, group_ids, jss_cache_ttl)
+if args.group != None:
+    for gid in args.group:
+        if static_groups.get(gid) == None:
+            print('No such static group: ' + gid)
+            sys.exit(1)
+    stale = [static_groups.get(gid)[0] for gid in args.group]
+elif args.full:
+    stale = group_ids
+
+if len(stale) > 0:
+    started = time.time()
+    try:
+        failed = jss_cache.update_snapshot(s, jss_url, stale, args.workers)
+    except requests.exceptions.ConnectionError:
+        print('Cannot connect to ' + jss_url + ' .. exiting, rerun to continue with the missing groups')
+        sys.exit(1)
+    print('Loaded ' + str(len(stale) - len(failed)) + ' of ' + str(len(group_ids)) +
+          ' static group(s) in %.1f s' % (time.time() - started))
+    if failed:
+        print(str(len(failed)) + ' group(s) could not be loaded, rerun to retry them')
+        sys.exit(1)
+elif args.computer == None:
+    print('All ' + str(len(group_ids)) + ' static group(s) are up to date')
+
+if args.computer != None:
+    snapshot = jss_cache.MembershipSnapshot(jss_url)
+    for computer in args.computer:
+        print(computer + ':')
+        for gid in snapshot.groups_of(computer):
+            print('ID: %3d : %s' % static_groups.get(gid))